@@ -0,0 +1,167 @@
+import threading
+import time
+import traceback
+
+from lazy_logger import LazyLogger
+from timer_wheel import TimerWheel
+
+ONLINE = "online"
+OFFLINE = "offline"
+
+
+class DeviceAvailability:
+    __slots__ = ("topic", "mqtt_mgr", "feed", "sources", "online")
+
+    def __init__(self, topic, mqtt_mgr, feed):
+        self.topic = topic
+        self.mqtt_mgr = mqtt_mgr
+        self.feed = feed
+        self.sources = ()
+        self.online = None
+
+
+class AvailabilityTracker:
+    """
+    Publishes the availability of every device on its own retained topic,
+    which its discovery configs reference. A device goes offline when none
+    of its entity topics got a message for `timeout` seconds, and back
+    online with the next one.
+
+    The deadlines of all devices of all sites live in one TimerWheel, turned
+    by a single timer. A message only moves its device's deadline.
+    """
+
+    def __init__(self, app, timeout=300, resolution=1):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.timeout = timeout
+
+        self.wheel = TimerWheel(resolution=resolution)
+        # Availability topic -> DeviceAvailability
+        self.devices = {}
+        # Entity topic -> devices reading it. Topics carry the VRM ID, so
+        # devices on different brokers don't share them
+        self.routes = {}
+        # Messages move deadlines while the timer turns the wheel
+        self.lock = threading.Lock()
+
+        self.timer = app.run_every(self.tick, f"now+{resolution}", resolution)
+
+    def track(self, topic, mqtt_mgr, feed, sources):
+        """
+        Track a device, or update its entity topics.
+
+        :param topic: the availability topic of the device
+        :param mqtt_mgr: the MqttManager of the device's broker
+        :param feed: the EntityFeed of that broker
+        :param sources: the entity topics of the device
+        """
+        sources = tuple(dict.fromkeys(sources))
+        with self.lock:
+            device = self.devices.get(topic)
+            if device is None:
+                device = self.devices[topic] = DeviceAvailability(topic, mqtt_mgr, feed)
+            if sources == device.sources:
+                return
+
+            dropped = self._unroute(device)
+            device.sources = sources
+            for source in sources:
+                self.routes.setdefault(source, []).append(device)
+
+        for source in dropped:
+            if source not in self.routes:
+                feed.remove(source, self.handle)
+        for source in sources:
+            feed.add(source, self.handle)
+
+        # Seen just now, it was set up from its messages
+        self.touch(device, time.monotonic())
+
+    def untrack(self, topic):
+        """
+        Stop tracking a removed device, and clear its availability topic.
+        """
+        with self.lock:
+            device = self.devices.pop(topic, None)
+            if device is None:
+                return
+            self.wheel.cancel(topic)
+            dropped = self._unroute(device)
+
+        for source in dropped:
+            device.feed.remove(source, self.handle)
+        device.mqtt_mgr.publish(topic, "", qos=1, retain=True)
+
+    def _unroute(self, device):
+        """
+        :return: the topics no device reads anymore
+        """
+        dropped = []
+        for source in device.sources:
+            routes = self.routes.get(source)
+            if routes is None or device not in routes:
+                continue
+
+            routes.remove(device)
+            if not routes:
+                del self.routes[source]
+                dropped.append(source)
+
+        device.sources = ()
+        return dropped
+
+    def handle(self, topic, message):
+        now = time.monotonic()
+        for device in self.routes.get(topic, ()):
+            self.touch(device, now)
+
+    def touch(self, device, now):
+        with self.lock:
+            if device.topic not in self.devices:
+                return
+            self.wheel.schedule(device.topic, now + self.timeout)
+            changed = device.online is not True
+            device.online = True
+
+        if changed:
+            self.send(device)
+
+    def tick(self, kwargs=None):
+        """
+        Mark the devices whose deadline passed offline, called every
+        resolution seconds.
+        """
+        with self.lock:
+            expired = [self.devices[topic] for topic in self.wheel.advance(time.monotonic()) if topic in self.devices]
+            for device in expired:
+                device.online = False
+
+        for device in expired:
+            self.lazy_log.info("No messages from %s for %s seconds, marking it offline", device.topic, self.timeout)
+            self.send(device)
+
+    def resend(self, mqtt_mgr):
+        """
+        Publish the availability of every device of a broker again, after a
+        reconnect to a broker that may have lost its retained messages.
+        """
+        with self.lock:
+            devices = [device for device in self.devices.values() if device.mqtt_mgr is mqtt_mgr]
+
+        for device in devices:
+            self.send(device)
+
+    def send(self, device):
+        try:
+            # Retained, so HA knows the availability right after a restart
+            device.mqtt_mgr.publish(device.topic, ONLINE if device.online else OFFLINE, qos=1, retain=True)
+        except Exception as e:
+            self.app.log(f"Error publishing availability to {device.topic}: {e}")
+            self.app.log(traceback.format_exc())
+
+    def stop(self):
+        try:
+            self.app.cancel_timer(self.timer)
+        except Exception as e:
+            self.app.log(f"Error cancelling availability timer: {e}")
@@ -0,0 +1,69 @@
+"""
+Cold/warm startup benchmark for ConfigParser.load_all.
+
+Cold loads parse and validate every hardware YAML file, once with the pure
+Python loader and once with the C loader if PyYAML has it. Warm loads hit
+the compiled config cache.
+
+Run from the repository root:
+
+    python benchmarks/bench_config_load.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yaml
+
+import config_parser
+from config_parser import ConfigParser
+
+
+class _App:
+    def log(self, msg, level="INFO"):
+        pass
+
+
+def timed(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main(rounds=50):
+    app = _App()
+    parser = ConfigParser(app, folder="hardware")
+    cache_dir = tempfile.mkdtemp(prefix="victronlink-bench-")
+    parser.cache_path = os.path.join(cache_dir, "hardware.pickle")
+
+    def cold():
+        if os.path.exists(parser.cache_path):
+            os.remove(parser.cache_path)
+        parser.load_all()
+
+    try:
+        results = []
+
+        config_parser.SafeLoader = yaml.SafeLoader
+        results.append(("cold, pure Python loader", timed(cold, rounds)))
+
+        if hasattr(yaml, "CSafeLoader"):
+            config_parser.SafeLoader = yaml.CSafeLoader
+            results.append(("cold, C loader", timed(cold, rounds)))
+
+        parser.load_all()
+        results.append(("warm, config cache", timed(parser.load_all, rounds)))
+
+        for name, ms in results:
+            print(f"{name:<26} {ms:8.3f} ms")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
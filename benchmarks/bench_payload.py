@@ -0,0 +1,52 @@
+"""
+Payload handling benchmark: the old path, decoding and parsing the payload
+in every handler, against one payload.Message shared by all handlers.
+
+Run from the repository root:
+
+    python benchmarks/bench_payload.py
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payload import Message, JSON_BACKEND
+
+PAYLOAD = b'{"value": 51.43}'
+
+
+def old_path(handlers):
+    # As dispatch used to: decode per handler, every handler parses
+    for _ in range(handlers):
+        payload = PAYLOAD.decode()
+        json.loads(payload)["value"]
+
+
+def message_path(handlers):
+    message = Message("victron/N/x/battery/512/Dc/0/Voltage", PAYLOAD)
+    for _ in range(handlers):
+        message.value
+
+
+def timed(fn, handlers, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(handlers)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main(rounds=100000):
+    print(f"JSON backend: {JSON_BACKEND}")
+    print(f"{'handlers':>8} {'old us':>10} {'message us':>12}")
+
+    for handlers in (1, 2, 4):
+        old = timed(old_path, handlers, rounds)
+        new = timed(message_path, handlers, rounds)
+        print(f"{handlers:>8} {old:>10.3f} {new:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Micro-benchmark for MQTT dispatch matching.
+
+Replays a synthetic Venus OS topic stream against 10, 100 and 1000
+subscriptions, comparing the TopicIndex lookup with the linear
+topic_matches_sub scan MqttManager used before.
+
+Run from the repository root:
+
+    python benchmarks/bench_topic_index.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from topic_index import TopicIndex
+
+try:
+    from paho.mqtt.client import topic_matches_sub
+except ImportError:
+    topic_matches_sub = None
+
+VRM_ID = "c0619ab8d038"
+
+SERVICES = {
+    "system": (1, [
+        "Ac/Consumption/{phase}/Power", "Ac/Grid/{phase}/Power",
+        "Ac/Consumption/NumberOfPhases", "Dc/Battery/TimeToGo",
+        "Dc/Battery/Power", "Dc/Pv/Power", "VebusInstance", "Serial",
+    ]),
+    "vebus": (2, [
+        "Ac/Out/{phase}/V", "Ac/Out/{phase}/I", "Ac/Out/{phase}/P",
+        "Ac/ActiveIn/{phase}/P", "State", "Mode", "Alarms/GridLost",
+        "ProductName",
+    ]),
+    "battery": (4, [
+        "Dc/0/Voltage", "Dc/0/Current", "Dc/0/Power", "Dc/0/Temperature",
+        "Soc", "ProductName", "Manufacturer", "History/ChargedEnergy",
+    ]),
+    "solarcharger": (6, [
+        "Pv/V", "Yield/Power", "Dc/0/Voltage", "Dc/0/Current",
+        "History/Daily/0/Yield", "ProductName", "State",
+    ]),
+}
+
+
+def venus_topics():
+    topics = []
+    for service, (instances, paths) in SERVICES.items():
+        for instance in range(instances):
+            for path in paths:
+                for phase in ("L1", "L2", "L3") if "{phase}" in path else (None,):
+                    topics.append(
+                        f"victron/N/{VRM_ID}/{service}/{instance}/"
+                        + path.format(phase=phase)
+                    )
+    return topics
+
+
+def subscriptions(topics, count, rng):
+    subs = [
+        f"victron/N/{VRM_ID}/battery/+/ProductName",
+        f"victron/N/{VRM_ID}/vebus/+/ProductName",
+        f"victron/N/{VRM_ID}/solarcharger/+/ProductName",
+        "homeassistant/+/+/config",
+    ]
+    pool = list(topics)
+    rng.shuffle(pool)
+    subs.extend(pool[:max(0, count - len(subs))])
+
+    # Pad with subscriptions of other GX devices that never match
+    i = 0
+    while len(subs) < count:
+        subs.append(pool[i % len(pool)].replace(VRM_ID, f"other{i:07d}"))
+        i += 1
+
+    return subs[:count]
+
+
+def bench_linear(subs, stream):
+    start = time.perf_counter()
+    hits = 0
+    for topic in stream:
+        for sub in subs:
+            if sub == topic or topic_matches_sub(sub, topic):
+                hits += 1
+    return time.perf_counter() - start, hits
+
+
+def bench_index(subs, stream):
+    index = TopicIndex()
+    for sub in subs:
+        index.add(sub)
+
+    start = time.perf_counter()
+    hits = 0
+    for topic in stream:
+        hits += len(index.match(topic))
+    return time.perf_counter() - start, hits
+
+
+def main(messages=20000):
+    rng = random.Random(1)
+    topics = venus_topics()
+    stream = [rng.choice(topics) for _ in range(messages)]
+
+    print(f"{len(topics)} distinct topics, {messages} messages")
+    print(f"{'subs':>6} {'linear us/msg':>14} {'index us/msg':>13} {'speedup':>8}")
+
+    for count in (10, 100, 1000):
+        subs = subscriptions(topics, count, rng)
+        index_time, index_hits = bench_index(subs, stream)
+
+        if topic_matches_sub is None:
+            print(f"{count:>6} {'n/a':>14} {index_time / messages * 1e6:>13.2f} {'':>8}")
+            continue
+
+        linear_time, linear_hits = bench_linear(subs, stream)
+        assert linear_hits == index_hits, (linear_hits, index_hits)
+        print(
+            f"{count:>6} {linear_time / messages * 1e6:>14.2f} "
+            f"{index_time / messages * 1e6:>13.2f} "
+            f"{linear_time / index_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
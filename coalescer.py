@@ -0,0 +1,139 @@
+import math
+import threading
+from array import array
+
+
+class Coalescer:
+    """
+    Latest-value coalescing for high-rate topics. Every configured topic has
+    a slot in a compact table: its flush interval, deadband, last delivered
+    value and time, and the newest held back message.
+
+    A message is delivered right away if the slot's interval has passed since
+    the last delivery, or if its value moved at least the deadband away from
+    the last delivered value. Otherwise only the newest message is kept, and
+    due() hands it out once the interval is over.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # topic -> slot index
+        self.slots = {}
+        self.topics = []
+        self.interval = array('d')
+        self.deadband = array('d')
+        self.last_value = array('d')
+        self.last_flush = array('d')
+        self.pending = []
+
+    def __len__(self):
+        return len(self.topics)
+
+    def configure(self, topic, interval, deadband=None):
+        """
+        Coalesce a topic. If several entities configure the same topic, the
+        shortest interval and smallest deadband win.
+
+        :param topic: the concrete topic
+        :param interval: minimum seconds between deliveries
+        :param deadband: value change that is delivered immediately (optional)
+        """
+        deadband = math.inf if deadband is None else float(deadband)
+
+        with self.lock:
+            slot = self.slots.get(topic)
+            if slot is None:
+                self.slots[topic] = len(self.topics)
+                self.topics.append(topic)
+                self.interval.append(float(interval))
+                self.deadband.append(deadband)
+                self.last_value.append(math.nan)
+                self.last_flush.append(-math.inf)
+                self.pending.append(None)
+            else:
+                self.interval[slot] = min(self.interval[slot], float(interval))
+                self.deadband[slot] = min(self.deadband[slot], deadband)
+
+    def remove(self, topic):
+        """
+        Stop coalescing a topic. The last slot moves into its place, so the
+        table stays compact.
+
+        :return: the held back message of the topic, None if there is none
+        """
+        with self.lock:
+            slot = self.slots.pop(topic, None)
+            if slot is None:
+                return None
+
+            message = self.pending[slot]
+            last = len(self.topics) - 1
+            if slot != last:
+                moved = self.topics[last]
+                self.slots[moved] = slot
+                for table in (self.topics, self.interval, self.deadband, self.last_value, self.last_flush, self.pending):
+                    table[slot] = table[last]
+
+            for table in (self.topics, self.interval, self.deadband, self.last_value, self.last_flush, self.pending):
+                table.pop()
+
+            return message
+
+    @property
+    def min_interval(self):
+        return min(self.interval) if self.interval else None
+
+    def offer(self, topic, message, now):
+        """
+        Offer a received payload.Message.
+
+        :return: True if the message should be delivered now
+        """
+        if topic not in self.slots:
+            return True
+
+        with self.lock:
+            # Looked up again under the lock, remove() moves slots
+            slot = self.slots.get(topic)
+            if slot is None:
+                return True
+
+            significant = False
+            value = math.nan
+
+            if self.deadband[slot] != math.inf:
+                value = message.number_or_nan
+                last = self.last_value[slot]
+                significant = value == value and (last != last or abs(value - last) >= self.deadband[slot])
+
+            if significant or now - self.last_flush[slot] >= self.interval[slot]:
+                self._delivered(slot, value, now)
+                return True
+
+            self.pending[slot] = message
+            return False
+
+    def due(self, now):
+        """
+        Collect held back messages whose interval is over.
+
+        :return: list of (topic, message) tuples to deliver
+        """
+        flushed = []
+
+        with self.lock:
+            for slot, message in enumerate(self.pending):
+                if message is None or now - self.last_flush[slot] < self.interval[slot]:
+                    continue
+
+                value = message.number_or_nan if self.deadband[slot] != math.inf else math.nan
+                self._delivered(slot, value, now)
+                flushed.append((self.topics[slot], message))
+
+        return flushed
+
+    def _delivered(self, slot, value, now):
+        self.pending[slot] = None
+        self.last_flush[slot] = now
+        if value == value:
+            self.last_value[slot] = value
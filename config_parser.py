@@ -1,59 +1,198 @@
 import os
+import pickle
 import yaml
 
 from schema_validator import SchemaValidator, SchemaError
-from schemas.hardware import HARDWARE_SCHEMA
+from schemas.hardware import HARDWARE_SCHEMA, SCHEMA_VERSION, GLOBAL_PLACEHOLDERS
+
+# Prefer libyaml's C loader when PyYAML was built with it
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Bump when the cached format or the normalization changes
+CACHE_VERSION = 1
 
 class ConfigParser:
-    def __init__(self, app, folder):
+    def __init__(self, app, folder, cache=True):
         base = os.path.dirname(os.path.abspath(__file__))
         self.folder = os.path.join(base, folder)
         self.app = app
 
+        # Validated, normalized configs keyed by file stat, so an app reload
+        # with unchanged files skips parsing and validation
+        self.cache_path = None
+        if cache:
+            self.cache_path = os.path.join(base, ".cache", f"{folder}.pickle")
+
+        # File name -> ((mtime_ns, size), config) of the last load
+        self.entries = {}
+        # File name -> stat of a version that failed to load
+        self.failed = {}
+
     def load_all(self):
         self.app.log("Loading configs...")
-        
+
+        cache = self.load_cache()
+        entries = {}
         configs = []
 
-        for fname in os.listdir(self.folder):
+        for fname in sorted(os.listdir(self.folder)):
             if not fname.endswith((".yaml", ".yml")):
                 continue
 
             path = os.path.join(self.folder, fname)
 
             try:
-                with open(path, "r") as f:
-                    data = yaml.safe_load(f)
-
-                if not data:
-                    raise ValueError("Empty config file")
-
-                # Validate
-                SchemaValidator.validate(
-                    data,
-                    HARDWARE_SCHEMA,
-                    path=fname,
-                    log=self.app.log
-                )
+                st = os.stat(path)
+                stamp = (st.st_mtime_ns, st.st_size)
 
-                # Normalize (very light!)
-                normalized = self.normalize(data)
+                entry = cache.get(fname)
+                if entry is None or entry[0] != stamp:
+                    entry = (stamp, self.load_file(path, fname))
 
-                configs.append(normalized)
+                entries[fname] = entry
+                configs.append(entry[1])
 
             except SchemaError as e:
+                for error in e.errors:
+                    self.app.log(
+                        f"[ConfigParser] Schema error in {fname}: {error}",
+                        level="ERROR",
+                    )
+
+            except Exception as e:
                 self.app.log(
-                    f"[ConfigParser] Schema error in {fname}: {e}",
+                    f"[ConfigParser] Error loading {fname}: {e}",
                     level="ERROR",
                 )
 
+        if entries != cache:
+            self.save_cache(entries)
+
+        self.entries = entries
+        return configs
+
+    def poll(self):
+        """
+        Reload the files that changed since the last load. Files that fail to
+        load keep their last good config.
+
+        :return: list of (old config, new config) pairs of the changed files,
+                 old is None for added and new is None for removed files
+        """
+        changes = []
+        seen = set()
+
+        for fname in sorted(os.listdir(self.folder)):
+            if not fname.endswith((".yaml", ".yml")):
+                continue
+
+            seen.add(fname)
+            path = os.path.join(self.folder, fname)
+
+            try:
+                st = os.stat(path)
+                stamp = (st.st_mtime_ns, st.st_size)
+
+                old = self.entries.get(fname)
+                if (old is not None and old[0] == stamp) or self.failed.get(fname) == stamp:
+                    continue
+
+                self.app.log(f"[ConfigParser] Reloading {fname}")
+                self.failed[fname] = stamp
+                config = self.load_file(path, fname)
+                del self.failed[fname]
+
+                self.entries[fname] = (stamp, config)
+                changes.append((old[1] if old else None, config))
+
+            except SchemaError as e:
+                for error in e.errors:
+                    self.app.log(
+                        f"[ConfigParser] Schema error in {fname}: {error}",
+                        level="ERROR",
+                    )
+
             except Exception as e:
                 self.app.log(
-                    f"[ConfigParser] Error loading {fname}: {e}",
+                    f"[ConfigParser] Error reloading {fname}: {e}",
                     level="ERROR",
                 )
 
-        return configs
+        for fname in set(self.entries) - seen:
+            self.app.log(f"[ConfigParser] {fname} was removed")
+            _, config = self.entries.pop(fname)
+
+            # A renamed file changes its config, instead of adding a device
+            # type that is then removed
+            added = next(
+                (i for i, (old, new) in enumerate(changes) if old is None and new["type"] == config["type"]),
+                None
+            )
+            if added is not None:
+                changes[added] = (config, changes[added][1])
+            else:
+                changes.append((config, None))
+
+        if changes:
+            self.save_cache(self.entries)
+
+        return changes
+
+    def load_file(self, path, fname):
+        with open(path, "r") as f:
+            data = yaml.load(f, Loader=SafeLoader)
+
+        if not data:
+            raise ValueError("Empty config file")
+
+        # Validate
+        SchemaValidator.validate(
+            data,
+            HARDWARE_SCHEMA,
+            path=fname,
+            names=GLOBAL_PLACEHOLDERS,
+            log=self.app.log
+        )
+
+        # Normalize (very light!)
+        return self.normalize(data)
+
+    def cache_key(self):
+        return (CACHE_VERSION, SCHEMA_VERSION, repr(HARDWARE_SCHEMA), GLOBAL_PLACEHOLDERS)
+
+    def load_cache(self):
+        """
+        Load the cached configs, empty if there is no usable cache.
+
+        :return: dict of file name -> ((mtime_ns, size), config)
+        """
+        if not self.cache_path:
+            return {}
+
+        try:
+            with open(self.cache_path, "rb") as f:
+                key, entries = pickle.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.app.log(f"[ConfigParser] Ignoring unreadable config cache: {e}", level="WARNING")
+            return {}
+
+        return entries if key == self.cache_key() else {}
+
+    def save_cache(self, entries):
+        if not self.cache_path:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+
+            tmp = self.cache_path + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump((self.cache_key(), entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.cache_path)
+        except Exception as e:
+            self.app.log(f"[ConfigParser] Could not write config cache: {e}", level="WARNING")
 
     def normalize(self, data):
         """
@@ -63,9 +202,14 @@ class ConfigParser:
         # Ensure setup exists
         data.setdefault("setup", [])
 
+        # Optional entity fields set to null are absent
+        for entity in (data.get("entities") or []) + (data.get("derived") or []):
+            for key in [key for key, value in entity.items() if value is None]:
+                del entity[key]
+
         # Ensure device_info.identifiers is a list
         identifiers = data.get("device_info", {}).get("identifiers")
         if isinstance(identifiers, str):
             data["device_info"]["identifiers"] = [identifiers]
 
-        return data
\ No newline at end of file
+        return data
@@ -0,0 +1,285 @@
+import json
+import math
+import threading
+import time
+from array import array
+
+from lazy_logger import LazyLogger
+from topic_index import TopicIndex
+
+# NumPy is optional, the ring buffers fall back to the array module
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
+# Functions over the moving window of a sensor
+WINDOW_FUNCTIONS = ('mean', 'min', 'max')
+
+
+class RingBuffer:
+    """
+    The last `size` samples of a sensor, NaN where nothing was stored yet.
+    Its memory is fixed when it is created.
+    """
+
+    __slots__ = ("size", "data", "index")
+
+    def __init__(self, size):
+        self.size = max(1, int(size))
+        if _np is not None:
+            self.data = _np.full(self.size, _np.nan)
+        else:
+            self.data = array("d", [math.nan]) * self.size
+        self.index = 0
+
+    def push(self, value):
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.size
+
+    def reduce(self, function):
+        """
+        :param function: mean, min or max
+        :return: the function over the stored samples, None if there are none
+        """
+        if _np is not None:
+            samples = self.data[~_np.isnan(self.data)]
+            if not samples.size:
+                return None
+            return float(getattr(samples, function)())
+
+        samples = [value for value in self.data if value == value]
+        if not samples:
+            return None
+        if function == 'mean':
+            return math.fsum(samples) / len(samples)
+        return min(samples) if function == 'min' else max(samples)
+
+
+class DerivedSensor:
+    __slots__ = ("entity_id", "function", "state_topic", "sources", "scale", "interval", "latest",
+                 "total", "integrated", "buffer", "due", "sent")
+
+    def __init__(self, entity_id, function, state_topic):
+        self.entity_id = entity_id
+        self.function = function
+        self.state_topic = state_topic
+        self.sources = ()
+        self.scale = 1
+        self.interval = 10
+        # Concrete source topic -> its latest value
+        self.latest = {}
+        # Running integral, and when it was integrated up to
+        self.total = 0.0
+        self.integrated = None
+        self.buffer = None
+        self.due = 0
+        # Last published value
+        self.sent = None
+
+    def current(self):
+        """
+        The sum of the latest values of all sources, None before the first.
+        """
+        return math.fsum(self.latest.values()) if self.latest else None
+
+    def integrate(self, now):
+        """
+        Add the current value over the time since the last call, in value
+        hours times the scale.
+        """
+        current = self.current()
+        if current is not None and self.integrated is not None:
+            self.total += current * (now - self.integrated) / 3600 * self.scale
+        self.integrated = now
+
+    def value(self):
+        if self.function == 'integral':
+            return self.total
+        if self.buffer is not None:
+            return self.buffer.reduce(self.function)
+        return self.current()
+
+
+class DerivedPublisher:
+    """
+    Computes derived sensors from entity topics inside VictronLink: sums of
+    several sources, like the phases of a system or all solar chargers, their
+    integral over time, and the mean, min or max over a moving window. Home
+    Assistant gets them as plain sensors, without template or Riemann sum
+    helpers.
+
+    Window functions sample the sum of the sources every `interval` seconds
+    into a ring buffer of window / interval samples, so a sensor's memory is
+    constant however often its sources update.
+    """
+
+    def __init__(self, app, mqtt_mgr, feed, prefix):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.mqtt_mgr = mqtt_mgr
+        self.feed = feed
+        self.prefix = prefix
+
+        # Source topic, possibly with wildcards -> sensors reading it
+        self.routes = {}
+        self.index = TopicIndex()
+        # entity_id -> DerivedSensor
+        self.sensors = {}
+        # entity_id -> integral restored from a snapshot
+        self.restored = {}
+        # Messages update the sensors while a timer publishes them
+        self.lock = threading.Lock()
+
+    def register(self, entity_id, sources, derived_config):
+        """
+        Add a derived sensor, or update it after its config or sources changed.
+
+        :param entity_id: the resolved entity id
+        :param sources: the resolved source topics
+        :param derived_config: the derived configuration
+        :return: the state topic of the sensor
+        """
+        function = derived_config['function']
+        dropped = []
+
+        with self.lock:
+            sensor = self.sensors.get(entity_id)
+            if sensor is None or sensor.function != function:
+                if sensor is not None:
+                    dropped += self._unroute(sensor)
+                sensor = self.sensors[entity_id] = DerivedSensor(entity_id, function, f"{self.prefix}/{entity_id}")
+                sensor.total = self.restored.pop(entity_id, 0.0)
+
+            sensor.scale = derived_config.get('scale', 1)
+            sensor.interval = derived_config.get('interval', 10)
+
+            if function in WINDOW_FUNCTIONS:
+                size = math.ceil(derived_config.get('window', 300) / sensor.interval)
+                if sensor.buffer is None or sensor.buffer.size != size:
+                    sensor.buffer = RingBuffer(size)
+            else:
+                sensor.buffer = None
+
+            sources = tuple(sources)
+            if sources != sensor.sources:
+                dropped += self._unroute(sensor)
+                sensor.sources = sources
+                sensor.latest.clear()
+                for topic in sources:
+                    routes = self.routes.get(topic)
+                    if routes is None:
+                        routes = self.routes[topic] = []
+                        self.index.add(topic)
+                    routes.append(sensor)
+
+        # The feed (un)subscribes, outside of the lock handle() takes
+        for topic in dropped:
+            if topic not in self.routes:
+                self.feed.remove(topic, self.handle)
+        for topic in sources:
+            self.feed.add(topic, self.handle)
+
+        return sensor.state_topic
+
+    def unregister(self, entity_id):
+        """
+        Stop computing a derived sensor, e.g. after it was removed from its
+        config.
+        """
+        with self.lock:
+            sensor = self.sensors.pop(entity_id, None)
+            if sensor is None:
+                return
+            dropped = self._unroute(sensor)
+
+        for topic in dropped:
+            self.feed.remove(topic, self.handle)
+
+    def _unroute(self, sensor):
+        """
+        Remove a sensor from the routes of its sources.
+
+        :return: the topics no sensor reads anymore
+        """
+        dropped = []
+        for topic in sensor.sources:
+            routes = self.routes.get(topic)
+            if routes is None or sensor not in routes:
+                continue
+
+            routes.remove(sensor)
+            if not routes:
+                del self.routes[topic]
+                self.index.remove(topic)
+                dropped.append(topic)
+
+        sensor.sources = ()
+        return dropped
+
+    def handle(self, topic, message):
+        value = message.number
+        if value is None:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            for source in self.index.match(topic):
+                for sensor in self.routes.get(source, ()):
+                    if sensor.function == 'integral':
+                        # The previous value held until now
+                        sensor.integrate(now)
+                    sensor.latest[topic] = value
+
+    def tick(self, kwargs=None):
+        """
+        Sample and publish the sensors that are due, called every second.
+        """
+        if not self.sensors:
+            return
+
+        now = time.monotonic()
+        payloads = []
+
+        with self.lock:
+            for sensor in self.sensors.values():
+                if now < sensor.due:
+                    continue
+                sensor.due = now + sensor.interval
+
+                if sensor.function == 'integral':
+                    sensor.integrate(now)
+                elif sensor.buffer is not None:
+                    current = sensor.current()
+                    if current is not None:
+                        sensor.buffer.push(current)
+
+                value = sensor.value()
+                if value is None:
+                    continue
+
+                value = round(value, 3)
+                if value != sensor.sent:
+                    sensor.sent = value
+                    payloads.append((sensor.state_topic, json.dumps({"value": value})))
+
+        for topic, payload in payloads:
+            # Retained, so HA has the state right after a restart
+            self.mqtt_mgr.publish(topic, payload, retain=True)
+            self.lazy_log.debug("Published derived %s -> %s", topic, payload)
+
+    def snapshot(self):
+        """
+        The integrals, so energy totals survive a restart.
+        """
+        with self.lock:
+            totals = dict(self.restored)
+            totals.update(
+                (entity_id, sensor.total) for entity_id, sensor in self.sensors.items()
+                if sensor.function == 'integral'
+            )
+            return totals
+
+    def restore(self, totals):
+        with self.lock:
+            self.restored.update(totals)
@@ -0,0 +1,188 @@
+import traceback
+
+from lazy_logger import LazyLogger
+
+
+class DeviceDiscovery:
+    """
+    Discovers device instances from wildcard topics like
+    {prefix}/N/{vrm_id}/battery/+/ProductName.
+
+    Known instances are kept per device type and checked before any string
+    work, so the regular republish of a discovery topic costs a set lookup.
+    Once no new device showed up for `settle` seconds the wildcard
+    subscriptions are dropped. rediscover() subscribes again, for hot-plugged
+    devices.
+    """
+
+    def __init__(self, app, mqtt_mgr, registry, on_device, settle=30, scope=None):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.mqtt_mgr = mqtt_mgr
+        self.registry = registry
+        # Registry scope the discovery topics are resolved in
+        self.scope = scope
+        self.on_device = on_device
+        self.settle_time = settle
+
+        # Device type -> set of known instances
+        self.known = {}
+        # Discovery topic of known instances -> device type
+        self.known_topics = {}
+        # Resolved discovery topic -> (device config, instance level)
+        self.watches = {}
+        self.device_configs = []
+        self.settle_timer = None
+        self.started = False
+
+    @property
+    def active(self):
+        return bool(self.watches)
+
+    def start(self, device_configs):
+        """
+        Start discovery for all device configs. Devices without a discovery
+        topic can't have multiple instances and are added directly as
+        instance 0.
+
+        :param device_configs: the hardware configs
+        """
+        self.device_configs = list(device_configs)
+        self.started = True
+
+        for device_config in device_configs:
+            discovery_topic = device_config.get("discovery")
+            if discovery_topic:
+                self.watch(device_config)
+            else:
+                self.found(device_config, 0, None)
+
+        self.arm_settle()
+
+    def watch(self, device_config):
+        topic = self.registry.resolve(device_config["discovery"], self.scope)
+
+        # The instance id is the first wildcard level
+        levels = topic.split("/")
+        if "+" not in levels:
+            self.app.log(f"Discovery topic {topic} of {device_config['type']} has no wildcard", level="WARNING")
+            return
+
+        self.app.log(f"Discover device {device_config['type']}")
+        self.watches[topic] = (device_config, levels.index("+"))
+        self.known.setdefault(device_config["type"], set())
+        self.mqtt_mgr.subscribe(topic, self.handle, topic)
+
+    def handle(self, topic, message, userdata):
+        if topic in self.known_topics:
+            return
+
+        watch = self.watches.get(userdata)
+        if watch is None:
+            return
+
+        device_config, level = watch
+        levels = topic.split("/")
+        if level >= len(levels):
+            return
+
+        self.found(device_config, levels[level], topic)
+
+    def found(self, device_config, instance, topic):
+        device_type = device_config["type"]
+        instances = self.known.setdefault(device_type, set())
+
+        if topic:
+            self.known_topics[topic] = device_type
+        if instance in instances:
+            return
+
+        instances.add(instance)
+
+        try:
+            if self.on_device(device_type, instance, device_config):
+                self.app.log(f"Added new {device_type} device of instance {instance}")
+        except Exception as e:
+            self.app.log(f"Error adding {device_type} device {instance}: {e}")
+            self.app.log(traceback.format_exc())
+
+        # Something new showed up, give the others time to do the same
+        if self.watches:
+            self.arm_settle()
+
+    def arm_settle(self):
+        self.cancel_settle()
+        if self.watches and self.settle_time:
+            self.settle_timer = self.app.run_in(self.settle, self.settle_time)
+
+    def cancel_settle(self):
+        if self.settle_timer is not None:
+            try:
+                self.app.cancel_timer(self.settle_timer)
+            except Exception:
+                pass
+            self.settle_timer = None
+
+    def settle(self, kwargs=None):
+        """
+        Discovery settled, drop the wildcard subscriptions.
+        """
+        self.settle_timer = None
+        self.app.log(f"Discovery settled, known devices: {self.known}")
+
+        for topic in list(self.watches):
+            self.mqtt_mgr.unsubscribe(topic)
+        self.watches.clear()
+
+    def rediscover(self):
+        """
+        Subscribe to the discovery topics again, to pick up devices added
+        since discovery settled. Known devices are skipped.
+        """
+        if self.watches:
+            self.arm_settle()
+            return
+
+        self.app.log("Rediscovering devices")
+        for device_config in self.device_configs:
+            if device_config.get("discovery"):
+                self.watch(device_config)
+
+        self.arm_settle()
+
+    def replace(self, old_config, new_config):
+        """
+        Swap a device config after a reload. Instances of a removed config are
+        forgotten, a new config is discovered right away. Before discovery
+        started only the config list is updated.
+
+        :param old_config: the config to replace, None for an added config
+        :param new_config: the new config, None for a removed config
+        """
+        if old_config is not None:
+            self.device_configs = [config for config in self.device_configs if config is not old_config]
+
+            for topic, watch in list(self.watches.items()):
+                if watch[0] is old_config:
+                    self.mqtt_mgr.unsubscribe(topic)
+                    del self.watches[topic]
+
+            if new_config is None or new_config["type"] != old_config["type"]:
+                self.known.pop(old_config["type"], None)
+                self.known_topics = {
+                    topic: device_type for topic, device_type in self.known_topics.items()
+                    if device_type != old_config["type"]
+                }
+
+        if new_config is None:
+            return
+
+        self.device_configs.append(new_config)
+        if not self.started:
+            return
+
+        if new_config.get("discovery"):
+            self.watch(new_config)
+            self.arm_settle()
+        else:
+            self.found(new_config, 0, None)
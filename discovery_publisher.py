@@ -0,0 +1,296 @@
+import hashlib
+import json
+import threading
+import traceback
+from collections import OrderedDict
+
+from lazy_logger import LazyLogger
+
+DISCOVERY_PREFIX = "homeassistant"
+
+ORIGIN = {"name": "VictronLink"}
+
+
+class DiscoveryPublisher:
+    """
+    Publishes Home Assistant discovery configs through a bounded outbound
+    queue. All payloads of a device are built at once and queued, and at most
+    `inflight` publishes are handed to paho before their acknowledgement, so
+    a (re)connect doesn't turn into a burst of hundreds of synchronous
+    publishes.
+
+    In "device" mode one homeassistant/device/.../config message carries all
+    components of a device, instead of one message per entity.
+
+    A digest of every config on the broker is kept, seeded from the retained
+    configs at startup, so unchanged configs are not published again and
+    configs of entities removed from a device are cleared.
+    """
+
+    def __init__(self, app, mqtt_mgr, qos=1, inflight=10, queue_size=1000, mode="entity"):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.mqtt_mgr = mqtt_mgr
+        self.qos = qos
+        self.inflight_window = max(1, inflight)
+        self.queue_size = queue_size
+        self.device_mode = mode == "device"
+
+        self.lock = threading.RLock()
+        # topic -> payload, a newer payload for a queued topic replaces it
+        self.queue = OrderedDict()
+        # mid -> topic of publishes waiting for an acknowledgement
+        self.inflight = {}
+        # Publishes handed to paho whose mid isn't recorded yet, and mids
+        # paho's network thread acknowledged before they were recorded
+        self.sending = 0
+        self.acked = set()
+        # Held while publishing, so queued configs of a topic reach the
+        # broker in order. paho holds its own lock while it calls
+        # on_publish, which therefore only takes self.lock
+        self.publish_lock = threading.Lock()
+        self.pump_scheduled = False
+
+        # topic -> digest of the config retained on the broker
+        self.digests = {}
+        # topic -> device key of configs published by VictronLink, seeded
+        # from the broker and updated with every published device
+        self.owned = {}
+        # Topics restored from a snapshot that the seed hasn't confirmed yet
+        self.unconfirmed = set()
+
+        mqtt_mgr.add_publish_listener(self.on_publish)
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def publish_device(self, device_id, device_info, entities):
+        """
+        Queue the discovery config of a device and all its entities.
+
+        :param device_id: the device id, unique over all sites, e.g. c0619ab8d038_battery_0
+        :param device_info: the resolved HA device info
+        :param entities: list of (component, entity_id, payload) tuples
+        """
+        device_key = _device_key(device_info)
+
+        if self.device_mode:
+            components = {}
+            for component, entity_id, payload in entities:
+                cmp = {"p": component}
+                cmp.update(payload)
+                components[entity_id] = cmp
+
+            payload = {"dev": device_info, "o": ORIGIN, "cmps": components}
+            messages = [(f"{DISCOVERY_PREFIX}/device/{device_id}/config", json.dumps(payload))]
+        else:
+            messages = []
+            for component, entity_id, payload in entities:
+                payload = dict(payload, device=device_info, origin=ORIGIN)
+                messages.append((self.entity_topic(component, entity_id), json.dumps(payload)))
+
+        # Clear configs this device had on the broker, but doesn't have anymore
+        topics = {topic for topic, _ in messages}
+        with self.lock:
+            for topic, key in list(self.owned.items()):
+                if key == device_key and topic not in topics:
+                    messages.append((topic, ""))
+            for topic in topics:
+                self.owned[topic] = device_key
+
+        self.enqueue_many(messages)
+
+    def retract_device(self, device_info):
+        """
+        Remove all configs of a device from the broker.
+
+        :param device_info: the resolved HA device info
+        """
+        device_key = _device_key(device_info)
+
+        with self.lock:
+            topics = [topic for topic, key in self.owned.items() if key == device_key]
+
+        self.enqueue_many([(topic, "") for topic in topics])
+
+    def publish_entity(self, component, entity_id, payload):
+        payload = dict(payload, origin=ORIGIN)
+        self.enqueue(self.entity_topic(component, entity_id), json.dumps(payload))
+
+    def seed(self, topic, message, userdata):
+        """
+        Handler for the retained homeassistant/+/+/config messages, recording
+        what is already on the broker.
+        """
+        payload = message.text
+        config = message.json
+
+        # Seeding runs on the network thread while pump() and snapshot() use
+        # the same dicts
+        with self.lock:
+            self.unconfirmed.discard(topic)
+
+            if not payload:
+                self.digests.pop(topic, None)
+                self.owned.pop(topic, None)
+                return
+
+            self.digests[topic] = _digest(payload)
+
+            if not isinstance(config, dict):
+                return
+
+            origin = config.get("origin") or config.get("o") or {}
+            if isinstance(origin, dict) and origin.get("name") == ORIGIN["name"]:
+                self.owned[topic] = _device_key(config.get("device") or config.get("dev"))
+
+    def snapshot(self):
+        with self.lock:
+            return {"digests": dict(self.digests), "owned": dict(self.owned)}
+
+    def restore(self, state):
+        """
+        Restore the digests of a snapshot, so configs that didn't change
+        aren't published again right after a restart. They count as
+        unconfirmed until the seed saw them on the broker.
+        """
+        with self.lock:
+            self.digests.update(state.get("digests", {}))
+            self.owned.update(state.get("owned", {}))
+            self.unconfirmed.update(state.get("digests", {}))
+
+    def unconfirm(self):
+        """
+        Count every known config as unconfirmed again, after a reconnect to a
+        broker that may have lost its retained messages.
+        """
+        with self.lock:
+            self.unconfirmed.update(self.digests)
+
+    def drop_unconfirmed(self):
+        """
+        Forget restored digests of configs the seed didn't find on the
+        broker, called when seeding ends.
+
+        :return: the number of dropped digests
+        """
+        with self.lock:
+            dropped = len(self.unconfirmed)
+            for topic in self.unconfirmed:
+                self.digests.pop(topic, None)
+            self.unconfirmed.clear()
+
+        return dropped
+
+    def entity_topic(self, component, entity_id):
+        return f"{DISCOVERY_PREFIX}/{component}/{entity_id}/config"
+
+    def enqueue(self, topic, payload):
+        self.enqueue_many([(topic, payload)])
+
+    def enqueue_many(self, messages):
+        with self.lock:
+            for topic, payload in messages:
+                if self.digests.get(topic) == (_digest(payload) if payload else None):
+                    # Already on the broker, drop anything older still queued
+                    self.queue.pop(topic, None)
+                    continue
+                self.queue[topic] = payload
+
+            while len(self.queue) > self.queue_size:
+                topic, _ = self.queue.popitem(last=False)
+                self.lazy_log.warning("Discovery queue full, dropped %s", topic)
+
+        self.pump()
+
+    def pump(self, kwargs=None):
+        """
+        Hand queued messages to paho while the inflight window has room.
+        """
+        with self.publish_lock:
+            while True:
+                with self.lock:
+                    self.pump_scheduled = False
+                    batch = []
+                    while self.queue and len(self.inflight) + len(batch) < self.inflight_window:
+                        batch.append(self.queue.popitem(last=False))
+                    if not batch:
+                        return
+                    self.sending += len(batch)
+
+                # Without self.lock, paho takes its own locks to publish
+                for topic, payload in batch:
+                    try:
+                        # Retain so HA remembers it after restart
+                        info = self.mqtt_mgr.publish(topic, payload, qos=self.qos, retain=True)
+                    except Exception as e:
+                        self.app.log(f"Error publishing discovery to {topic}: {e}")
+                        self.app.log(traceback.format_exc())
+                        info = None
+
+                    with self.lock:
+                        self.sending -= 1
+                        if info is not None:
+                            self.record(info.mid, topic, payload)
+                        if not self.sending:
+                            self.acked.clear()
+
+    def record(self, mid, topic, payload):
+        """
+        Record a publish handed to paho, called with the lock held. A mid
+        acknowledged before it got here frees its slot right away.
+        """
+        self.lazy_log.debug("Published discovery -> %s", topic)
+        if mid in self.acked:
+            self.acked.discard(mid)
+        else:
+            self.inflight[mid] = topic
+        self.unconfirmed.discard(topic)
+
+        if payload:
+            self.digests[topic] = _digest(payload)
+        else:
+            self.digests.pop(topic, None)
+            self.owned.pop(topic, None)
+
+    def on_publish(self, mid):
+        """
+        Publish listener, called on paho's network thread. The next batch is
+        published by a timer, not from within paho's callback.
+        """
+        with self.lock:
+            # Other publishes, like keepalives, are acknowledged here too
+            if self.inflight.pop(mid, None) is None:
+                if self.sending:
+                    self.acked.add(mid)
+                return
+
+            if not self.queue or self.pump_scheduled:
+                return
+            self.pump_scheduled = True
+
+        self.app.run_in(self.pump, 0)
+
+    def reset(self):
+        """
+        Forget publishes that were in flight, they won't be acknowledged after
+        a connection loss. Called on (re)connect.
+        """
+        with self.lock:
+            self.inflight.clear()
+
+        self.pump()
+
+
+def _digest(payload):
+    return hashlib.blake2b(payload.encode(), digest_size=16).digest()
+
+
+def _device_key(device_info):
+    if not isinstance(device_info, dict):
+        return None
+    identifiers = device_info.get("identifiers")
+    if isinstance(identifiers, list):
+        return tuple(identifiers)
+    return identifiers
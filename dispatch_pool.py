@@ -0,0 +1,127 @@
+import threading
+import traceback
+import zlib
+from collections import deque
+
+POLICIES = ("coalesce", "drop_oldest", "drop_newest")
+
+# Outcomes of queueing a message
+QUEUED = "queued"
+COALESCED = "coalesced"
+DROPPED = "dropped"
+
+
+class DispatchPool:
+    """
+    Runs message handlers on worker threads, so paho's network thread only
+    has to enqueue. A topic always goes to the same worker, which keeps the
+    order of messages per topic.
+
+    Every worker queue is bounded. When a queue is full, the policy decides:
+    "coalesce" replaces the message of the newest queued message of the same
+    topic and otherwise drops the oldest message, "drop_oldest" drops the
+    oldest message and "drop_newest" drops the new one.
+    """
+
+    def __init__(self, app, dispatch, workers=2, queue_size=1000, policy="coalesce", metrics=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown dispatch policy {policy}, expected one of {POLICIES}")
+
+        self.app = app
+        self.metrics = metrics
+        self.workers = [
+            _Worker(self, dispatch, queue_size, policy, f"victronlink-dispatch-{i}")
+            for i in range(max(1, workers))
+        ]
+
+        for worker in self.workers:
+            worker.thread.start()
+
+    @property
+    def depth(self):
+        return sum(len(worker.queue) for worker in self.workers)
+
+    def submit(self, topic, message):
+        worker = self.workers[zlib.crc32(topic.encode()) % len(self.workers)]
+        outcome = worker.put(topic, message)
+        if outcome is not QUEUED and self.metrics:
+            # A coalesced message was replaced by a newer one, nothing is lost
+            self.metrics.incr(f"dispatch.{outcome}")
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+class _Worker:
+
+    def __init__(self, pool, dispatch, queue_size, policy, name):
+        self.pool = pool
+        self.dispatch = dispatch
+        self.queue_size = queue_size
+        self.policy = policy
+
+        # Entries are [topic, message, queued]
+        self.queue = deque()
+        # topic -> newest queued entry of that topic
+        self.newest = {}
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def put(self, topic, message):
+        """
+        Queue a message.
+
+        :return: QUEUED, COALESCED if it replaced a queued message of the
+                 same topic, or DROPPED if a message was dropped
+        """
+        outcome = QUEUED
+
+        with self.cond:
+            if len(self.queue) >= self.queue_size:
+                if self.policy == "drop_newest":
+                    return DROPPED
+
+                if self.policy == "coalesce":
+                    entry = self.newest.get(topic)
+                    if entry is not None:
+                        entry[1] = message
+                        return COALESCED
+
+                outcome = DROPPED
+                self._pop()
+
+            entry = [topic, message, True]
+            self.queue.append(entry)
+            self.newest[topic] = entry
+            self.cond.notify()
+
+        return outcome
+
+    def _pop(self):
+        entry = self.queue.popleft()
+        entry[2] = False
+        if self.newest.get(entry[0]) is entry:
+            del self.newest[entry[0]]
+        return entry
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                topic, message, _ = self._pop()
+
+            try:
+                self.dispatch(topic, message)
+            except Exception as e:
+                self.pool.app.log(f"Error dispatching {topic}: {e}")
+                self.pool.app.log(traceback.format_exc())
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
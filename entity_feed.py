@@ -0,0 +1,56 @@
+import threading
+import traceback
+
+
+class EntityFeed:
+    """
+    Fans out the messages of entity topics to everything in VictronLink that
+    consumes them. MqttManager has one handler per subscription, so every
+    topic is subscribed once here, however many consumers it has.
+
+    Consumers are callables taking (topic, message), with the payload.Message
+    every consumer of a topic shares. They are added and removed from timers,
+    the setup coordinator and handlers, so the consumers of a topic are
+    replaced instead of changed while a message is handed to them.
+    """
+
+    def __init__(self, app, mqtt_mgr):
+        self.app = app
+        self.mqtt_mgr = mqtt_mgr
+        # Subscription topic -> tuple of consumers
+        self.consumers = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, topic):
+        return topic in self.consumers
+
+    def add(self, topic, consumer):
+        with self.lock:
+            consumers = self.consumers.get(topic)
+            if consumers is None:
+                self.consumers[topic] = (consumer,)
+                self.mqtt_mgr.subscribe(topic, self.handle, topic)
+            elif consumer not in consumers:
+                self.consumers[topic] = consumers + (consumer,)
+
+    def remove(self, topic, consumer):
+        with self.lock:
+            consumers = self.consumers.get(topic)
+            if not consumers or consumer not in consumers:
+                return
+
+            consumers = tuple(c for c in consumers if c != consumer)
+            if consumers:
+                self.consumers[topic] = consumers
+            else:
+                del self.consumers[topic]
+                self.mqtt_mgr.unsubscribe(topic)
+
+    def handle(self, topic, message, userdata):
+        # userdata is the subscription topic, which may have wildcards
+        for consumer in self.consumers.get(userdata, ()):
+            try:
+                consumer(topic, message)
+            except Exception as e:
+                self.app.log(f"Error in entity consumer for {topic}: {e}")
+                self.app.log(traceback.format_exc())
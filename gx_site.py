@@ -0,0 +1,850 @@
+import math
+import time
+import traceback
+
+from mqtt_manager import MqttManager
+from lazy_logger import LazyLogger
+from keepalive import Keepalive, keepalive_topics
+from discovery_publisher import DiscoveryPublisher, DISCOVERY_PREFIX
+from device_discovery import DeviceDiscovery
+from entity_feed import EntityFeed
+from state_publisher import StatePublisher, AggregateStatePublisher
+from derived import DerivedPublisher
+from availability import ONLINE, OFFLINE
+
+# Retained discovery configs, used to seed the discovery digests
+SEED_TOPIC = f"{DISCOVERY_PREFIX}/+/+/config"
+
+
+class Connection:
+    """
+    A broker connection, shared by all sites bridged to the same broker.
+    Discovery configs and subscriptions are per broker, so the discovery
+    publisher and the entity feed live here as well.
+    """
+
+    def __init__(self, app, host, port=1883, username=None, password=None, metrics=None,
+                 availability=None):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.metrics = metrics
+        self.host = host
+        self.key = (host, port, username)
+        self.sites = []
+        self.connected_at = None
+        # Finds the VRM IDs of sites set to "auto", see VictronLink.add_site
+        self.vrm_discovery = None
+        self.vrm_args = None
+        self.seed_timer = None
+        self.availability = availability
+
+        self.mqtt_mgr = MqttManager(
+            app=app,
+            host=host,
+            port=port,
+            username=username,
+            password=password,
+            metrics=metrics,
+            dispatch_workers=app.args.get("dispatch_workers", 0),
+            dispatch_queue_size=app.args.get("dispatch_queue_size", 1000),
+            dispatch_policy=app.args.get("dispatch_policy", "coalesce"),
+            reconnect_min_delay=app.args.get("reconnect_min_delay", 1),
+            reconnect_max_delay=app.args.get("reconnect_max_delay", 120)
+        )
+
+        self.discovery = DiscoveryPublisher(
+            app=app,
+            mqtt_mgr=self.mqtt_mgr,
+            qos=app.args.get("discovery_qos", 1),
+            inflight=app.args.get("discovery_inflight", 10),
+            queue_size=app.args.get("discovery_queue_size", 1000),
+            mode=app.args.get("discovery_mode", "entity")
+        )
+
+        # Consumers of entity topics inside VictronLink
+        self.entity_feed = EntityFeed(app=app, mqtt_mgr=self.mqtt_mgr)
+
+        # Availability of the bridge itself, the broker sets it offline when
+        # the connection is lost
+        self.status_topic = None
+        if availability:
+            self.status_topic = app.args.get("availability_topic", "victronlink/status")
+            self.mqtt_mgr.will_set(self.status_topic, OFFLINE)
+
+    def availability_topics(self):
+        """
+        The availability topics discovery configs of the bridge reference.
+        """
+        return [self.status_topic] if self.status_topic else []
+
+    def connect(self):
+        self.mqtt_mgr.connect(self.on_connect)
+
+    def disconnect(self):
+        if self.status_topic:
+            # A clean disconnect doesn't trigger the will
+            self.mqtt_mgr.publish(self.status_topic, OFFLINE, qos=1, retain=True)
+        self.mqtt_mgr.disconnect()
+
+    def on_connect(self, rc):
+        if rc == 0:
+            # Sites keep their devices and registry over a reconnect, the
+            # MqttManager restores the subscriptions
+            reconnect = self.connected_at is not None
+            self.app.log(f"{'Reconnected' if reconnect else 'Connected successfully'} to {self.host}")
+            self.connected_at = time.monotonic()
+            if self.metrics:
+                self.metrics.incr("connects")
+            self.lazy_log.refresh()
+            if self.status_topic:
+                self.mqtt_mgr.publish(self.status_topic, ONLINE, qos=1, retain=True)
+                if reconnect:
+                    self.availability.resend(self.mqtt_mgr)
+            self.discovery.reset()
+            if reconnect:
+                # The broker may have restarted without its retained configs
+                self.discovery.unconfirm()
+            self.seed_discovery()
+            if self.vrm_discovery and not self.vrm_discovery.found:
+                self.vrm_discovery.start()
+            for site in list(self.sites):
+                if reconnect:
+                    site.on_reconnect()
+                else:
+                    site.on_connect()
+        else:
+            self.app.log(f"Failed to connect to {self.host}, return code {rc}")
+
+    def seed_discovery(self):
+        """
+        Subscribe to the retained discovery configs for a while, so configs
+        already on the broker aren't published again.
+        """
+        self.mqtt_mgr.subscribe(SEED_TOPIC, self.discovery.seed, None)
+
+        # A reconnect during the seed starts it over
+        if self.seed_timer is not None:
+            try:
+                self.app.cancel_timer(self.seed_timer)
+            except Exception:
+                pass
+        self.seed_timer = self.app.run_in(self.end_seed_discovery, self.app.args.get("discovery_seed_time", 10))
+
+    def end_seed_discovery(self, kwargs):
+        self.seed_timer = None
+        self.mqtt_mgr.unsubscribe(SEED_TOPIC)
+
+        # Configs of the snapshot that aren't on the broker anymore
+        dropped = self.discovery.drop_unconfirmed()
+        if dropped:
+            self.app.log(f"{dropped} discovery configs of the snapshot are missing on {self.host}, publishing them again")
+            for site in self.sites:
+                site.republish()
+
+
+class Site:
+    """
+    One GX device, identified by its VRM ID. A site has its own registry
+    scope, pre-setup, device discovery and devices, and publishes through the
+    Connection of its broker. Every device gets a scope below the site's.
+
+    The hardware configs and the registry are shared by all sites.
+    Settings are the app's, overridden by the site's own entries.
+    """
+
+    def __init__(self, app, vrm_id, connection, device_configs, setup_coordinator,
+                 registry, availability=None, args=None):
+        self.app = app
+        self.vrm_id = vrm_id
+        self.connection = connection
+        self.mqtt_mgr = connection.mqtt_mgr
+        self.discovery = connection.discovery
+        self.device_configs = device_configs
+        self.setup_coordinator = setup_coordinator
+        self.metrics = connection.metrics
+        self.args = args if args is not None else app.args
+
+        self.registry = registry
+        self.scope = registry.scope(vrm_id)
+        self.availability = availability
+        self.devices = {}
+        self.connected_at = None
+        # Devices restored from a snapshot, set up again once pre-setup is done
+        self.restored = []
+        # Pre-setup values not received yet, None before the first pre-setup
+        self.pre_setup_pending = None
+
+        # Used to map tags to actual values
+        self.topic_prefix = self.args.get("topic_prefix", "victron")
+        self.registry.add('vrm_id', vrm_id, self.scope)
+        self.registry.add('prefix', self.topic_prefix, self.scope)
+
+        # TODO Better format to parse the result into mappers automatically
+        self.pre_setup_config = [
+            {
+                'name': "bus_number",
+                'topic': "{prefix}/N/{vrm_id}/system/0/VebusInstance",
+                'handler': self.handle_registry,
+                'store': 'bus_id'
+            },
+            {
+                'name': "number_of_phases",
+                'topic': "{prefix}/N/{vrm_id}/system/0/Ac/Consumption/NumberOfPhases",
+                'handler': self.handle_phases,
+                'store': 'phase_id'
+            }
+        ]
+
+        self.device_discovery = DeviceDiscovery(
+            app=app,
+            mqtt_mgr=self.mqtt_mgr,
+            registry=self.registry,
+            on_device=self.add_device,
+            settle=self.args.get("discovery_settle", 30),
+            scope=self.scope
+        )
+
+        # "direct" lets HA read the Venus OS topics, "republish" routes them
+        # through VictronLink's deadband/throttle first and "aggregate"
+        # publishes one state document per device
+        self.state_mode = self.args.get("state_mode", "direct")
+        self.state_publisher = None
+        if self.state_mode == "aggregate":
+            self.state_publisher = AggregateStatePublisher(
+                app=app,
+                mqtt_mgr=self.mqtt_mgr,
+                feed=connection.entity_feed,
+                prefix=f"victronlink/{vrm_id}/state"
+            )
+            flush_interval = self.args.get("state_flush_interval", 5)
+            app.run_every(self.state_publisher.flush, f"now+{flush_interval}", flush_interval)
+        elif self.state_mode == "republish":
+            self.state_publisher = StatePublisher(
+                app=app,
+                mqtt_mgr=self.mqtt_mgr,
+                feed=connection.entity_feed,
+                prefix=f"victronlink/{vrm_id}/state",
+                defaults={
+                    'deadband': self.args.get("state_deadband", 0),
+                    'min_interval': self.args.get("state_min_interval", 0),
+                    'max_interval': self.args.get("state_max_interval", 300)
+                }
+            )
+            app.run_every(self.state_publisher.tick, "now+1", 1)
+
+        # Sensors computed from entity topics, see the derived configs
+        self.derived = DerivedPublisher(
+            app=app,
+            mqtt_mgr=self.mqtt_mgr,
+            feed=connection.entity_feed,
+            prefix=f"victronlink/{vrm_id}/derived"
+        )
+        app.run_every(self.derived.tick, "now+1", 1)
+
+        self.keepalive = None
+        if self.args.get("keepalive", True):
+            self.keepalive = Keepalive(
+                app=app,
+                mqtt_mgr=self.mqtt_mgr,
+                topic=f"{self.topic_prefix}/R/{vrm_id}/keepalive",
+                topics=self.keepalive_topics(),
+                interval=self.args.get("keepalive_interval", 30)
+            )
+
+        connection.sites.append(self)
+
+    def log(self, msg, level="INFO"):
+        self.app.log(f"[{self.vrm_id}] {msg}", level=level)
+
+    def on_connect(self):
+        self.connected_at = time.monotonic()
+        if self.keepalive:
+            self.keepalive.start()
+
+        # Publish from the snapshot right away, setup reconciles afterwards
+        if self.restored:
+            self.log(f"Publishing {len(self.restored)} devices from the snapshot")
+            self.republish()
+
+        self.setup()
+
+    def on_reconnect(self):
+        """
+        Resume after a connection loss. Devices and the registry are kept and
+        their subscriptions restored, so known devices aren't set up again.
+        Only a site that never started pre-setup runs the setup.
+        """
+        self.connected_at = time.monotonic()
+        if self.keepalive:
+            self.keepalive.start()
+
+        if self.pre_setup_pending is None:
+            self.setup()
+
+    def snapshot(self):
+        """
+        The state of the site for a snapshot. Device configs are left out,
+        they are looked up by type on restore.
+        """
+        devices = [
+            {key: device[key] for key in ('instance', 'dev_type', 'device_info', 'entities') if key in device}
+            for instances in list(self.devices.values())
+            for device in list(instances.values())
+        ]
+        return {'registry': self.registry.dump(self.scope), 'devices': devices, 'derived': self.derived.snapshot()}
+
+    def restore(self, state):
+        """
+        Restore a snapshot of the site, before connecting. Devices whose type
+        has no config anymore are skipped.
+        """
+        self.registry.load(state.get('registry', {}))
+        self.derived.restore(state.get('derived', {}))
+
+        configs = {config['type']: config for config in self.device_configs}
+        for stored in state.get('devices', []):
+            config = configs.get(stored['dev_type'])
+            if config is None:
+                continue
+
+            device = dict(stored, id=f"{stored['dev_type']}_{stored['instance']}", config=config)
+            device['scope'] = self.registry.scope(f"{self.vrm_id}/{device['id']}", self.scope)
+            self.devices.setdefault(device['dev_type'], {})[device['instance']] = device
+            self.device_discovery.known.setdefault(device['dev_type'], set()).add(device['instance'])
+            self.restored.append(device)
+
+        self.log(f"Restored {len(self.restored)} devices from the snapshot")
+
+    def republish(self):
+        """
+        Publish all set up devices again, the discovery digests skip what is
+        already on the broker.
+        """
+        for instances in list(self.devices.values()):
+            for device in list(instances.values()):
+                if 'device_info' in device:
+                    self.publish_device(device)
+
+    def reconcile(self):
+        """
+        Set up the devices restored from the snapshot again with live values.
+        """
+        restored, self.restored = self.restored, []
+        for device in restored:
+            self.device_setup(device)
+
+    def stop(self):
+        if self.keepalive:
+            self.keepalive.stop()
+
+    def keepalive_topics(self):
+        """
+        Collect every topic the loaded hardware configs can subscribe to, for
+        the keepalive topic list. Expanded levels, like {phase}, aren't known
+        yet and become wildcards.
+        """
+        topics = [config['topic'] for config in self.pre_setup_config]
+
+        for device_config in self.device_configs:
+            topics.append(device_config.get('discovery'))
+            topics.extend(step['topic'] for step in device_config.get('setup', []))
+            topics.extend(entity['topic'] for entity in device_config.get('entities', []))
+            topics.extend(
+                source['topic'] for derived in device_config.get('derived', []) for source in derived['sources']
+            )
+
+        return keepalive_topics(
+            self.registry.resolve(topics, self.scope),
+            f"{self.topic_prefix}/N/{self.vrm_id}/"
+        )
+
+    def setup(self):
+        self.log("Running setup...")
+        self.pre_setup()
+
+    def pre_setup(self):
+        """
+        Run pre-setup, fetching the data needed for most other topic, data
+        like the VRM ID.
+        """
+
+        try:
+            self.log("Running pre-setup. Setting up one-shot subscribers...")
+
+            self.pre_setup_started = time.monotonic()
+
+            # Create a set, keeping track of all the pre-setup calls
+            self.pre_setup_pending = set()
+            for config in self.pre_setup_config:
+                # Keep track of what's left to fetch
+                self.pre_setup_pending.add(config['store'])
+                self.mqtt_mgr.subscribe_one_shot(self.registry.resolve(config['topic'], self.scope), config['handler'], {'store': config['store']})
+
+        except Exception as e:
+            self.log(f"Error during pre-setup: {e}")
+            self.log(traceback.format_exc())
+
+    def post_setup(self):
+        try:
+            self.log("Running post-setup")
+
+            now = time.monotonic()
+            self.metrics.observe("setup.pre_setup", (now - self.pre_setup_started) * 1000)
+            self.metrics.observe("setup.connect_to_post_setup", (now - self.connected_at) * 1000)
+
+            self.discover_devices()
+            self.reconcile()
+        except Exception as e:
+            self.log(f"Error during post-setup: {e}")
+            self.log(traceback.format_exc())
+
+    def discover_devices(self):
+        try:
+            self.log("Discover devices")
+            self.device_discovery.start(self.device_configs)
+        except Exception as e:
+            self.log(f"Error during discover devices: {e}")
+            self.log(traceback.format_exc())
+
+    def rediscover(self):
+        self.device_discovery.rediscover()
+
+    def reload_config(self, old_config, new_config):
+        """
+        Apply a changed hardware config to the running devices. Devices of the
+        type are published again, the discovery digests skip the entities that
+        didn't change and configs of removed entities are cleared. The shared
+        config list is already updated.
+
+        :param old_config: the config before the change, None if it is new
+        :param new_config: the config after the change, None if it was removed
+        """
+        if old_config and new_config and old_config['type'] != new_config['type']:
+            self.reload_config(old_config, None)
+            self.reload_config(None, new_config)
+            return
+
+        dev_type = (new_config or old_config)['type']
+        self.log(f"Reloading {dev_type}: {diff_entities(old_config, new_config)}")
+
+        for instance, device in list(self.devices.get(dev_type, {}).items()):
+            if new_config is None:
+                self.remove_device(device)
+                continue
+
+            device['config'] = new_config
+            # Without the old config, e.g. added while devices of its type
+            # exist, everything may have changed
+            if old_config is None or old_config.get('setup') != new_config.get('setup'):
+                self.device_setup(device)
+            else:
+                self.publish_device(device)
+
+        if new_config is None:
+            self.devices.pop(dev_type, None)
+
+        self.device_discovery.replace(old_config, new_config)
+
+        if self.keepalive:
+            self.keepalive.topics = self.keepalive_topics()
+
+    def remove_device(self, device):
+        self.log(f"Remove device: {device['id']}")
+
+        if 'device_info' in device:
+            self.discovery.retract_device(device['device_info'])
+        for entity_id in device.get('entities', ()):
+            if self.state_publisher:
+                self.state_publisher.unregister(entity_id)
+            self.derived.unregister(entity_id)
+        if self.availability:
+            self.availability.untrack(self.availability_topic(device))
+        for topic in device.get('coalesce', ()):
+            self.mqtt_mgr.uncoalesce(topic)
+        self.registry.discard(device['scope'])
+        self.registry.drop_scope(device['scope'])
+
+    def add_device(self, dev_type, instance, config):
+        """
+        Receive device discovery message. Add a new device if this was the first
+        time it sends the message.
+
+        :param dev_type: the device type
+        :param instance: the instance id of the device
+        :param config: the attached device configuration
+        """
+
+        # Create type bucket if missing
+        if dev_type not in self.devices:
+            self.devices[dev_type] = {}
+
+        # Add only if new
+        if instance not in self.devices[dev_type]:
+            device = {
+                'id': f"{dev_type}_{instance}",
+                'instance': instance,
+                'dev_type': dev_type,
+                'config': config
+            }
+            device['scope'] = self.registry.scope(f"{self.vrm_id}/{device['id']}", self.scope)
+            self.devices[dev_type][instance] = device
+            # TODO Handle none instance devices (system)
+            self.registry.add(config['instance_id'], instance, device['scope'])
+
+            self.device_setup(device)
+
+            return True
+
+        return False
+
+    def device_setup(self, device):
+        """
+        Run device setup. This will fetch device specific data needed for
+        topics and Home Assistant device info.
+
+        :param device: the device information
+        """
+
+        self.log(f"Device setup {device['config']['type']}[{device['instance']}]")
+
+        device['setup_started'] = time.monotonic()
+
+        config = device['config']
+        setup_steps = config.get('setup', [])
+
+        if not setup_steps:
+            self.log(f"No setup steps for {config['type']}[{device['instance']}], publishing immediately.")
+            self.publish_device(device)
+            return
+
+        # Runs all steps at once, publishing the device when they are done
+        self.setup_coordinator.setup_device(device, setup_steps, self)
+
+    def publish_device(self, device):
+        """
+        Publish the device. Will resolve all needed device information and then
+        publish it to the MQTT bus where Home Assistant will pick it up.
+
+        :param device: the device information
+        """
+
+        self.log(f"Publish device: {device['id']}")
+
+        start = time.monotonic()
+        setup_started = device.pop('setup_started', None)
+        if setup_started is not None:
+            self.metrics.observe(f"device_setup.{device['dev_type']}", (start - setup_started) * 1000)
+
+        device_config = device['config']
+
+        self.resolve_device_info(device)
+
+        # Publish all the entities of this device to Home Assistant in one
+        # batch, it will set up HA to listen to them directly
+        entities = []
+        entity_ids = set()
+        sources = []
+        # Topic -> (interval, deadband), the smallest of all entities reading it
+        coalesced = {}
+        for template in device_config['entities']:
+            for entity_config in self.expand_entity(template, device):
+                sources.append(self.registry.resolve(entity_config['topic'], device['scope']))
+                entity = self.build_entity_discovery(entity_config, device)
+                if entity:
+                    entities.append(entity)
+                    entity_ids.add(entity[1])
+
+                coalesce = entity_config.get('coalesce')
+                if coalesce:
+                    topic = self.registry.resolve(entity_config['topic'], device['scope'])
+                    interval, deadband = coalesced.get(topic, (math.inf, math.inf))
+                    coalesced[topic] = (
+                        min(interval, coalesce['interval']),
+                        min(deadband, coalesce.get('deadband', math.inf))
+                    )
+
+        self.update_coalesce(device, coalesced)
+
+        for derived_config in device_config.get('derived', []):
+            entity = self.build_derived_discovery(derived_config, device)
+            if entity:
+                entities.append(entity)
+                entity_ids.add(entity[1])
+
+        # Online before Home Assistant reads the configs referencing it
+        if self.availability:
+            self.availability.track(
+                self.availability_topic(device), self.mqtt_mgr, self.connection.entity_feed, sources
+            )
+
+        # Sites can share a broker, device ids are only unique on their own
+        self.discovery.publish_device(f"{self.vrm_id}_{device['id']}", device['device_info'], entities)
+
+        # Entities dropped by a config reload
+        for entity_id in device.get('entities', set()) - entity_ids:
+            if self.state_publisher:
+                self.state_publisher.unregister(entity_id)
+            self.derived.unregister(entity_id)
+        device['entities'] = entity_ids
+
+        self.metrics.incr("discovery.entities", len(entities))
+        self.metrics.observe(f"discovery.{device['dev_type']}", (time.monotonic() - start) * 1000)
+
+    def update_coalesce(self, device, coalesced):
+        """
+        Apply the coalesce settings of a device's entities, dropping those a
+        config reload removed or changed.
+
+        :param device: the device information
+        :param coalesced: topic -> (interval, deadband) of the device
+        """
+        old = device.get('coalesce', {})
+
+        for topic, settings in old.items():
+            if coalesced.get(topic) != settings:
+                self.mqtt_mgr.uncoalesce(topic)
+
+        for topic, (interval, deadband) in coalesced.items():
+            if old.get(topic) != (interval, deadband):
+                self.mqtt_mgr.coalesce(topic, interval, None if deadband == math.inf else deadband)
+
+        device['coalesce'] = coalesced
+
+    # Generic data store for dynamic values
+    def handle_registry(self, topic, message, userdata):
+        value = int(message.value)
+
+        self.republish_consumers(self.registry.add(userdata['store'], value, self.scope))
+
+        self.remove_pre_setup_pending(userdata['store'])
+
+    # TODO Can we do this generically instead?
+    def handle_phases(self, topic, message, userdata):
+        phase_count = int(message.value)
+
+        # Generate phase IDs like L1, L2, L3, ... based on phase_count
+        phases = [f"L{i+1}" for i in range(phase_count)]
+        self.republish_consumers(self.registry.add('phase_id', phases, self.scope))
+
+        self.remove_pre_setup_pending(userdata['store'])
+
+    def republish_consumers(self, consumers):
+        """
+        Publish the devices again that rendered a changed registry value,
+        e.g. a VE.Bus instance that changed while connected.
+
+        :param consumers: device scopes returned by Registry.add
+        """
+        if not consumers:
+            return
+
+        for instances in list(self.devices.values()):
+            for device in list(instances.values()):
+                if device['scope'] in consumers and 'device_info' in device:
+                    self.publish_device(device)
+
+    def remove_pre_setup_pending(self, store):
+        self.log(f"Pre setup pending before: {self.pre_setup_pending}")
+        self.pre_setup_pending.remove(store)
+
+        if len(self.pre_setup_pending) == 0:
+            self.post_setup()
+
+    def resolve_device_info(self, device):
+        old_info = device.get('device_info')
+        device['device_info'] = self.registry.resolve(device['config']['device_info'], device['scope'], device['scope'])
+
+        if isinstance(old_info, dict) and old_info.get('identifiers') != device['device_info'].get('identifiers'):
+            # Home Assistant gets a new device, clear the configs of the old
+            # one. Other changes, like its name, are plain config updates
+            self.discovery.retract_device(old_info)
+
+        self.log(f"New device info: {device['device_info']}")
+
+    def availability_topic(self, device):
+        return f"victronlink/{self.vrm_id}/availability/{device['id']}"
+
+    def availability_topics(self, device):
+        """
+        The availability topics of a device's discovery configs: the bridge's
+        and the device's own, both have to be online.
+        """
+        if not self.availability:
+            return []
+        return self.connection.availability_topics() + [self.availability_topic(device)]
+
+    def expand_entity(self, entity_config, device):
+        """
+        Expand an entity template over a registry list, e.g. over phase_id
+        as phase, into one entity per value. The name, entity_id and topic
+        get {phase}, {phase_lower} and {phase_index} (1-based) filled in.
+
+        :param entity_config: the entity configuration
+        :param device: the device information
+        :return: list of entity configurations
+        """
+        expand = entity_config.get('expand')
+        if not expand:
+            return [entity_config]
+
+        values = self.registry.get(expand['over'], device['scope'], consumer=device['scope'])
+        if not isinstance(values, list):
+            self.log(f"Can't expand {entity_config.get('entity_id', entity_config.get('topic'))}, {expand['over']} is not a list: {values}", level="WARNING")
+            return []
+
+        name = expand['as']
+        entities = []
+        for index, value in enumerate(values):
+            bindings = {
+                name: value,
+                f"{name}_lower": str(value).lower(),
+                f"{name}_index": index + 1
+            }
+            entity = {key: value for key, value in entity_config.items() if key != 'expand'}
+            for key in ('name', 'entity_id', 'topic'):
+                if key in entity:
+                    entity[key] = self.registry.bind(entity[key], bindings)
+            entities.append(entity)
+
+        return entities
+
+    def build_entity_discovery(self, entity_config, device):
+        """
+        Build the discovery payload of a device entity.
+
+        :param entity_config: the entity configuration
+        :param device: the device information
+        :return: a (component, entity_id, payload) tuple, None on error
+        """
+        try:
+            # Use the entity's value_template if it exists, otherwise default to "{{ value_json.value }}"
+            value_template = entity_config.get('value_template', "{{ value_json.value }}")
+            # default to sensor
+            component = entity_config.get('component', 'sensor')
+
+            scope = device['scope']
+            entity_id = self.registry.resolve(entity_config['entity_id'], scope, scope)
+            state_topic = self.registry.resolve(entity_config['topic'], scope, scope)
+            name = self.registry.resolve(entity_config['name'], scope, scope)
+
+            if self.state_publisher:
+                state_topic, value_template = self.state_publisher.register(
+                    entity_id, state_topic, entity_config, device['id'], value_template
+                )
+
+            payload = build_discovery(
+                entity_id=entity_id,
+                state_topic=state_topic,
+                name=name,
+                device_class=entity_config.get('device_class'),
+                unit_of_measurement=entity_config.get('unit_of_measurement'),
+                icon=entity_config.get('icon'),
+                value_template=value_template,
+                availability=self.availability_topics(device)
+            )
+
+            return component, entity_id, payload
+        except Exception as e:
+            self.log(f"Error during build entity discovery: {e}")
+            self.log(traceback.format_exc())
+            return None
+
+    def build_derived_discovery(self, derived_config, device):
+        """
+        Register a derived sensor and build its discovery payload. Sources
+        with `expand` become one topic per value, e.g. one per phase.
+
+        :param derived_config: the derived configuration
+        :param device: the device information
+        :return: a (component, entity_id, payload) tuple, None on error
+        """
+        try:
+            scope = device['scope']
+            entity_id = self.registry.resolve(derived_config['entity_id'], scope, scope)
+            name = self.registry.resolve(derived_config.get('name', entity_id), scope, scope)
+
+            sources = [
+                self.registry.resolve(source['topic'], scope, scope)
+                for template in derived_config['sources']
+                for source in self.expand_entity(template, device)
+            ]
+
+            state_topic = self.derived.register(entity_id, sources, derived_config)
+
+            default_state_class = 'total' if derived_config['function'] == 'integral' else 'measurement'
+            payload = build_discovery(
+                entity_id=entity_id,
+                state_topic=state_topic,
+                name=name,
+                device_class=derived_config.get('device_class'),
+                unit_of_measurement=derived_config.get('unit_of_measurement'),
+                icon=derived_config.get('icon'),
+                value_template="{{ value_json.value }}",
+                state_class=derived_config.get('state_class', default_state_class),
+                availability=self.availability_topics(device)
+            )
+
+            return 'sensor', entity_id, payload
+        except Exception as e:
+            self.log(f"Error during build derived discovery: {e}")
+            self.log(traceback.format_exc())
+            return None
+
+
+def build_discovery(entity_id, state_topic, name, device_class=None,
+                    unit_of_measurement=None, icon=None, device=None,
+                    value_template=None, state_class=None, availability=None):
+    """
+    Build the Home Assistant MQTT discovery payload of an entity.
+
+    :param entity_id: unique identifier for this entity
+    :param state_topic: the topic HA should subscribe to for state updates
+    :param name: human-readable name
+    :param device_class: HA device class (optional)
+    :param unit_of_measurement: unit of measurement (optional)
+    :param icon: mdi icon (optional)
+    :param device: dict with device info (optional)
+    :param value_template: optional value_template string
+    :param state_class: HA state class of a sensor (optional)
+    :param availability: availability topics, all must be online (optional)
+    :return: the payload dict
+    """
+    payload = {
+        "name": name,
+        "state_topic": state_topic,
+        "unique_id": entity_id,
+    }
+
+    if device_class:
+        payload["device_class"] = device_class
+    if unit_of_measurement:
+        payload["unit_of_measurement"] = unit_of_measurement
+    if icon:
+        payload["icon"] = icon
+    if value_template:
+        payload["value_template"] = value_template
+    if state_class:
+        payload["state_class"] = state_class
+    if availability:
+        payload["availability"] = [{"topic": topic} for topic in availability]
+        payload["availability_mode"] = "all"
+    if device:
+        payload["device"] = device
+
+    return payload
+
+
+def diff_entities(old_config, new_config):
+    """
+    Summarize how the entities of a device config changed, for the log.
+
+    :return: e.g. "1 added, 0 removed, 2 changed"
+    """
+    old = {entity['entity_id']: entity for entity in (old_config or {}).get('entities', [])}
+    new = {entity['entity_id']: entity for entity in (new_config or {}).get('entities', [])}
+
+    added = len(new.keys() - old.keys())
+    removed = len(old.keys() - new.keys())
+    changed = sum(1 for key in old.keys() & new.keys() if old[key] != new[key])
+
+    return f"{added} added, {removed} removed, {changed} changed"
@@ -0,0 +1,79 @@
+import json
+import traceback
+
+from lazy_logger import LazyLogger
+
+
+class Keepalive:
+    """
+    Keeps the Venus OS broker publishing. The GX only publishes N/ topics while
+    it receives keepalives on R/{vrm_id}/keepalive, and stops about 60 seconds
+    after the last one.
+
+    The keepalive carries the list of topics VictronLink actually uses, so the
+    GX doesn't have to push its whole dbus tree. Re-armed keepalives ask for
+    "suppress-republish", only the first one after (re)connecting requests a
+    full publish of the current values.
+    """
+
+    def __init__(self, app, mqtt_mgr, topic, topics, interval=30):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.mqtt_mgr = mqtt_mgr
+        self.topic = topic
+        self.topics = topics
+        self.interval = interval
+        self.timer = None
+
+    def start(self):
+        """
+        Send a full keepalive and (re-)arm the timer. Called on every connect.
+        """
+        self.stop()
+        self.send(full=True)
+        self.timer = self.app.run_every(self.rearm, f"now+{self.interval}", self.interval)
+
+    def stop(self):
+        if self.timer is not None:
+            try:
+                self.app.cancel_timer(self.timer)
+            except Exception as e:
+                self.app.log(f"Error cancelling keepalive timer: {e}")
+            self.timer = None
+
+    def rearm(self, kwargs):
+        self.send(full=False)
+
+    def send(self, full):
+        try:
+            options = [] if full else ["suppress-republish"]
+            if self.topics:
+                options.append({"topics": self.topics})
+
+            self.mqtt_mgr.publish(self.topic, json.dumps({"keepalive-options": options}))
+            self.lazy_log.debug("Sent keepalive to %s (full=%s)", self.topic, full)
+        except Exception as e:
+            self.app.log(f"Error sending keepalive: {e}")
+            self.app.log(traceback.format_exc())
+
+
+def keepalive_topics(topics, prefix):
+    """
+    Turn subscription topics into the topic list of a keepalive. Levels with
+    unresolved placeholders, like instance ids, become "+" wildcards, and the
+    "{prefix}/N/{vrm_id}/" part is stripped.
+
+    :param topics: the resolved topics, possibly with placeholders left
+    :param prefix: the topic prefix up to and including the VRM ID
+    :return: a sorted list of unique topics
+    """
+    result = set()
+
+    for topic in topics:
+        if not topic or not topic.startswith(prefix):
+            continue
+
+        levels = topic[len(prefix):].split("/")
+        result.add("/".join("+" if "{" in level else level for level in levels))
+
+    return sorted(result)
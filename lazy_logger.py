@@ -0,0 +1,108 @@
+import logging
+import time
+
+
+class LazyLogger:
+    """
+    Level-gated logging on top of AppDaemon's log. The effective log level is
+    cached, and messages use %-style arguments that are only formatted when
+    the message will actually be emitted.
+
+    Shared by VictronLink, MqttManager and Registry through for_app().
+    """
+
+    def __init__(self, app, sample_interval=None, sample_level="INFO"):
+        self.app = app
+        # Minimum seconds between two sampled messages with the same key
+        self.sample_interval = sample_interval
+        self.sample_level = sample_level
+        # key -> [last emitted time, suppressed count]
+        self.samples = {}
+        self.level = logging.INFO
+        self.refresh()
+
+    @classmethod
+    def for_app(cls, app):
+        """
+        Get the logger shared by everything belonging to an app, creating it
+        if the app has none yet.
+        """
+        lazy_log = getattr(app, "lazy_log", None)
+        if lazy_log is None:
+            lazy_log = app.lazy_log = cls(app)
+        return lazy_log
+
+    def refresh(self):
+        """
+        Re-read the effective level of the app's own logger, which follows
+        its log_level, e.g. after a config change.
+        """
+        try:
+            self.level = self.app.logger.getEffectiveLevel()
+        except Exception:
+            self.level = logging.INFO
+
+    def enabled(self, level):
+        return _LEVELS.get(level, logging.INFO) >= self.level
+
+    def log(self, level, msg, *args):
+        if _LEVELS.get(level, logging.INFO) < self.level:
+            return
+        if args:
+            msg = msg % args
+        self.app.log(msg, level=level)
+
+    def debug(self, msg, *args):
+        self.log("DEBUG", msg, *args)
+
+    def info(self, msg, *args):
+        self.log("INFO", msg, *args)
+
+    def warning(self, msg, *args):
+        self.log("WARNING", msg, *args)
+
+    def error(self, msg, *args):
+        self.log("ERROR", msg, *args)
+
+    @property
+    def sampling(self):
+        return bool(self.sample_interval)
+
+    def sampled(self, key, msg, *args):
+        """
+        Log at most one message per key and sample interval, at the sample
+        level. Suppressed messages are counted and reported with the next one.
+
+        :param key: the rate limiting key, usually the topic
+        :param msg: the message, with %-style placeholders
+        :param args: the message arguments
+        """
+        if not self.sampling or not self.enabled(self.sample_level):
+            return
+
+        now = time.monotonic()
+        sample = self.samples.get(key)
+
+        if sample is None:
+            self.samples[key] = [now, 0]
+        elif now - sample[0] < self.sample_interval:
+            sample[1] += 1
+            return
+        else:
+            suppressed = sample[1]
+            sample[0] = now
+            sample[1] = 0
+            if suppressed:
+                msg += " (%d suppressed)"
+                args += (suppressed,)
+
+        self.log(self.sample_level, msg, *args)
+
+
+_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "CRITICAL": logging.CRITICAL,
+}
@@ -0,0 +1,158 @@
+import re
+import threading
+import time
+from collections import deque
+
+
+class Histogram:
+    """
+    Latency histogram over a bounded window of the most recent samples, so
+    percentiles follow the current load and memory stays constant.
+    """
+
+    __slots__ = ("samples", "count")
+
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {"count": self.count, "p50": None, "p95": None, "p99": None}
+
+        last = len(samples) - 1
+        return {
+            "count": self.count,
+            "p50": round(samples[round(0.50 * last)], 3),
+            "p95": round(samples[round(0.95 * last)], 3),
+            "p99": round(samples[round(0.99 * last)], 3),
+        }
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the bridge. Latencies are in
+    milliseconds. Histogram names are dotted, like "handler.<name>" or
+    "device_setup.<type>".
+
+    Dispatch workers update them alongside paho's network thread, so updates
+    and snapshots hold a lock.
+    """
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.monotonic()
+        self.last_snapshot = (self.started, 0)
+        self.lock = threading.Lock()
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.window)
+            histogram.add(value)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        """
+        Summarize all metrics, including the message rate since the last
+        snapshot.
+
+        :return: a JSON serializable dict
+        """
+        now = time.monotonic()
+        with self.lock:
+            messages = self.counters.get("messages", 0)
+            last_time, last_messages = self.last_snapshot
+            self.last_snapshot = (now, messages)
+
+            counters = dict(self.counters)
+            hist = {name: h.summary() for name, h in self.histograms.items()}
+
+        elapsed = now - last_time
+        rate = (messages - last_messages) / elapsed if elapsed > 0 else 0.0
+
+        return {
+            "uptime": round(now - self.started),
+            "message_rate": round(rate, 2),
+            "counters": counters,
+            "gauges": dict(self.gauges),
+            "hist": hist,
+        }
+
+
+def slug(name):
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+def diagnostic_entities(snapshot, state_topic, prefix, availability=None):
+    """
+    Build the discovery payloads of the diagnostic sensors for a metrics
+    snapshot. Every histogram gets a sensor showing its p95, with all
+    percentiles as attributes.
+
+    :param snapshot: the snapshot, as published on state_topic
+    :param state_topic: the topic the snapshot is published on
+    :param prefix: the entity id prefix
+    :param availability: availability topics of the sensors (optional)
+    :return: list of (component, entity_id, payload) tuples
+    """
+    entities = [
+        _diagnostic(prefix, "Message Rate", state_topic, "{{ value_json.message_rate }}", unit="msg/s"),
+        _diagnostic(prefix, "Uptime", state_topic, "{{ value_json.uptime }}", unit="s", device_class="duration"),
+    ]
+
+    for name in sorted(snapshot["counters"]):
+        entities.append(_diagnostic(
+            prefix, name, state_topic, f"{{{{ value_json.counters['{name}'] }}}}",
+            state_class="total_increasing"
+        ))
+
+    for name in sorted(snapshot["gauges"]):
+        entities.append(_diagnostic(prefix, name, state_topic, f"{{{{ value_json.gauges['{name}'] }}}}"))
+
+    for name in sorted(snapshot["hist"]):
+        component, entity_id, payload = _diagnostic(
+            prefix, f"{name} p95", state_topic, f"{{{{ value_json.hist['{name}'].p95 }}}}", unit="ms"
+        )
+        payload["json_attributes_topic"] = state_topic
+        payload["json_attributes_template"] = f"{{{{ value_json.hist['{name}'] | tojson }}}}"
+        entities.append((component, entity_id, payload))
+
+    if availability:
+        for _, _, payload in entities:
+            payload["availability"] = [{"topic": topic} for topic in availability]
+
+    return entities
+
+
+def _diagnostic(prefix, name, state_topic, value_template, unit=None,
+                device_class=None, state_class="measurement"):
+    entity_id = f"{prefix}_{slug(name)}"
+    payload = {
+        "name": name,
+        "state_topic": state_topic,
+        "unique_id": entity_id,
+        "value_template": value_template,
+        "entity_category": "diagnostic",
+        "state_class": state_class,
+    }
+    if unit:
+        payload["unit_of_measurement"] = unit
+    if device_class:
+        payload["device_class"] = device_class
+    return "sensor", entity_id, payload
@@ -1,15 +1,28 @@
+import random
+import threading
+import time
 import traceback
 import paho.mqtt.client as mqtt
-from paho.mqtt.client import topic_matches_sub
+from topic_index import TopicIndex
+from lazy_logger import LazyLogger
+from dispatch_pool import DispatchPool
+from coalescer import Coalescer
+from payload import Message
 
 class MqttManager:
 
-    def __init__(self, app, host, port=1883, username=None, password=None):
+    def __init__(self, app, host, port=1883, username=None, password=None, metrics=None,
+                 dispatch_workers=0, dispatch_queue_size=1000, dispatch_policy="coalesce",
+                 reconnect_min_delay=1, reconnect_max_delay=120):
         self.app = app
+        self.metrics = metrics
+        self.lazy_log = LazyLogger.for_app(app)
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
 
         # MQTT client
         self.client = mqtt.Client()
@@ -17,8 +30,39 @@ class MqttManager:
         # Set callbacks
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
+        self.client.on_publish = self.on_publish
+        self.client.on_disconnect = self.on_disconnect
 
         self.topic_handlers = {}
+        # Topic tree over the keys of topic_handlers, used for dispatch
+        self.topic_index = TopicIndex()
+        # Called with the mid of every completed publish
+        self.publish_listeners = []
+        # Guards firing one-shot handlers when several threads dispatch
+        self.one_shot_lock = threading.Lock()
+        # Set while on_connect runs, subscriptions are then sent in one packet
+        self.batching = False
+
+        # Latest-value coalescing of high-rate topics, flushed on its own thread
+        self.coalescer = Coalescer()
+        self.flusher = None
+        self.flusher_stop = threading.Event()
+        # Held from taking a coalesced message until it is delivered, by the
+        # network thread and the flusher, so a held back message can't be
+        # delivered after a newer one
+        self.coalesce_lock = threading.RLock()
+
+        # Run handlers on worker threads instead of paho's network thread
+        self.pool = None
+        if dispatch_workers:
+            self.pool = DispatchPool(
+                app,
+                self.dispatch,
+                workers=dispatch_workers,
+                queue_size=dispatch_queue_size,
+                policy=dispatch_policy,
+                metrics=metrics
+            )
 
     def connect(self, on_connect=None):
         self.user_on_connect = on_connect
@@ -26,9 +70,37 @@ class MqttManager:
         if self.username or self.password:
             self.client.username_pw_set(self.username, self.password)
 
+        # paho doubles the delay between reconnect attempts up to the maximum
+        self.client.reconnect_delay_set(min_delay=self.reconnect_min_delay, max_delay=self.reconnect_max_delay)
+
         self.client.connect(self.host, self.port)
         self.client.loop_start()
 
+    def will_set(self, topic, payload):
+        """
+        Set the retained message the broker publishes when the connection is
+        lost, must be called before connect().
+        """
+        self.client.will_set(topic, payload, qos=1, retain=True)
+
+    def disconnect(self):
+        # Disconnect first, so the network thread still sends what is queued
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.flusher_stop.set()
+        if self.pool:
+            self.pool.stop()
+
+    @property
+    def queue_depth(self):
+        return self.pool.depth if self.pool else 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def add_publish_listener(self, listener):
+        self.publish_listeners.append(listener)
+
     def subscribe(self, topic, handler, userdata, one_shot=False):
         try:
             self.app.log(f"Subscribing to topic: {topic}")
@@ -36,13 +108,46 @@ class MqttManager:
             self.topic_handlers[topic] = {
                 'handler': handler,
                 'userdata': userdata,
-                'oneShot': one_shot
+                'oneShot': one_shot,
+                'metric': f"handler.{getattr(handler, '__qualname__', handler)}"
             }
-            self.client.subscribe(topic)
+            self.topic_index.add(topic)
+            if not self.batching:
+                self.client.subscribe(topic)
         except Exception as e:
             self.app.log(f"Error subscribing to topic {topic}: {e}")
             self.app.log(traceback.format_exc())
 
+    def coalesce(self, topic, interval, deadband=None):
+        """
+        Deliver at most one message per interval for a topic, keeping only the
+        newest payload, unless its value changes by at least the deadband.
+
+        :param topic: the concrete topic
+        :param interval: minimum seconds between deliveries
+        :param deadband: value change that is delivered immediately (optional)
+        """
+        self.coalescer.configure(topic, interval, deadband)
+
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self.flush_loop, name="victronlink-coalesce", daemon=True)
+            self.flusher.start()
+
+    def uncoalesce(self, topic):
+        """
+        Stop coalescing a topic, delivering its held back message.
+        """
+        with self.coalesce_lock:
+            message = self.coalescer.remove(topic)
+            if message is not None:
+                self.deliver(topic, message)
+
+    def flush_loop(self):
+        while not self.flusher_stop.wait(max(0.05, min(1.0, (self.coalescer.min_interval or 2.0) / 2))):
+            with self.coalesce_lock:
+                for topic, message in self.coalescer.due(time.monotonic()):
+                    self.deliver(topic, message)
+
     def subscribe_one_shot(self, topic, handler, userdata):
         try:
             self.subscribe(topic, handler, userdata, True)
@@ -54,39 +159,147 @@ class MqttManager:
 
         self.client.unsubscribe(topic)
         self.topic_handlers.pop(topic, None)
+        self.topic_index.remove(topic)
 
     # Internal callbacks
     def on_connect(self, client, userdata, flags, rc):
         self.app.log(f"MQTT Manager connected with code {rc}")
 
-        # Call user callback if set
-        if self.user_on_connect:
-            self.user_on_connect(rc)
+        if rc != 0:
+            if self.user_on_connect:
+                self.user_on_connect(rc)
+            return
+
+        # The broker doesn't keep subscriptions of a clean session. Collect
+        # the ones made by the callback and send them with every live handler
+        # in a single SUBSCRIBE
+        self.batching = True
+        try:
+            if self.user_on_connect:
+                self.user_on_connect(rc)
+        finally:
+            self.batching = False
+            self.resubscribe()
+
+    def resubscribe(self):
+        """
+        Subscribe to the topics of all handlers with one SUBSCRIBE packet.
+        """
+        topics = [(topic, 0) for topic in list(self.topic_handlers)]
+        if not topics:
+            return
+
+        try:
+            self.app.log(f"Subscribing to {len(topics)} topics")
+            self.client.subscribe(topics)
+        except Exception as e:
+            self.app.log(f"Error subscribing to {len(topics)} topics: {e}")
+            self.app.log(traceback.format_exc())
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc == 0:
+            # Requested by disconnect()
+            return
+
+        self.app.log(f"MQTT Manager lost the connection to {self.host} with code {rc}, reconnecting", level="WARNING")
+        if self.metrics:
+            self.metrics.incr("disconnects")
+
+        # A random first delay keeps bridges from reconnecting in lockstep
+        # after a broker restart, paho doubles it from there on
+        self.client.reconnect_delay_set(
+            min_delay=random.uniform(self.reconnect_min_delay, 2 * self.reconnect_min_delay),
+            max_delay=self.reconnect_max_delay
+        )
+
+    def on_publish(self, client, userdata, mid):
+        for listener in self.publish_listeners:
+            try:
+                listener(mid)
+            except Exception as e:
+                self.app.log(f"Error in publish listener: {e}")
+                self.app.log(traceback.format_exc())
 
     def on_message(self, client, userdata, msg):
-        self.app.log(f"Received message: {msg.topic} -> {msg.payload}", level="DEBUG")
         topic = msg.topic
-        
+
+        if self.lazy_log.sampling:
+            self.lazy_log.sampled(topic, "Received message: %s -> %s", topic, msg.payload)
+        else:
+            self.lazy_log.debug("Received message: %s -> %s", topic, msg.payload)
+
+        if self.metrics:
+            self.metrics.incr("messages")
+
+        # Messages nobody listens to are dropped before they are queued
+        if not self.topic_index.match(topic):
+            return
+
+        # Parsed at most once, by whoever needs the value first
+        message = Message(topic, msg.payload)
+
+        if topic in self.coalescer.slots:
+            with self.coalesce_lock:
+                if not self.coalescer.offer(topic, message, time.monotonic()):
+                    if self.metrics:
+                        self.metrics.incr("messages.coalesced")
+                    return
+
+                self.deliver(topic, message)
+            return
+
+        self.deliver(topic, message)
+
+    def deliver(self, topic, message):
+        if self.pool:
+            self.pool.submit(topic, message)
+        else:
+            self.dispatch(topic, message)
+
+    def dispatch(self, topic, message):
+        """
+        Call all handlers subscribed to a topic. Handlers take (topic,
+        message, userdata), with a payload.Message shared by all of them.
+
+        :param topic: the topic of the message
+        :param message: the payload.Message
+        """
+        metrics = self.metrics
+        matches = self.topic_index.match(topic)
+
         to_unsubscribe = []
 
-        # Iterate a copy, in case the handler subscribe/unsubscribe
-        for sub_topic, handler_entry in list(self.topic_handlers.items()):
-            # Match with wild card handling
-            if sub_topic == topic or topic_matches_sub(sub_topic, topic):
-                try:
-                    payload = msg.payload.decode()
-                    handler_entry['handler'](topic, payload, handler_entry['userdata'])
-                except Exception as e:
-                    self.app.log(f"Error handling message for topic {topic}: {e}")
-                    self.app.log(traceback.format_exc())
-                finally:
-                    if handler_entry.get('oneShot'):
-                        to_unsubscribe.append(sub_topic)
+        # The match result is immutable, so handlers may subscribe/unsubscribe
+        for sub_topic in matches:
+            handler_entry = self.topic_handlers.get(sub_topic)
+            if not handler_entry:
+                continue
+
+            if handler_entry['oneShot']:
+                with self.one_shot_lock:
+                    if handler_entry.get('fired'):
+                        continue
+                    handler_entry['fired'] = True
+
+            try:
+                start = time.perf_counter()
+                handler_entry['handler'](topic, message, handler_entry['userdata'])
+                if metrics:
+                    metrics.observe(handler_entry['metric'], (time.perf_counter() - start) * 1000)
+            except Exception as e:
+                self.app.log(f"Error handling message for topic {topic}: {e}")
+                self.app.log(traceback.format_exc())
+            finally:
+                if handler_entry['oneShot']:
+                    to_unsubscribe.append(sub_topic)
 
         # Remove unsubcribed listeners, usually due to one-shot
         for unsub in to_unsubscribe:
             try:
-                self.app.log(f"Unsubscribe {unsub}")
+                if self.topic_handlers.get(unsub, {}).get('fired') is not True:
+                    # The handler subscribed the topic again
+                    continue
+                self.lazy_log.debug("Unsubscribe %s", unsub)
                 self.unsubscribe(unsub)
             except Exception as e:
                 self.app.log(f"Failed to unsubscribe from {topic}: {e}")
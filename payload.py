@@ -0,0 +1,90 @@
+import json
+import math
+
+# Prefer a faster JSON parser when one is installed, all take bytes
+try:
+    import orjson as _json_backend
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import ujson as _json_backend
+        JSON_BACKEND = "ujson"
+    except ImportError:
+        _json_backend = json
+        JSON_BACKEND = "json"
+
+loads = _json_backend.loads
+
+# Marks a property that wasn't computed yet
+_UNSET = object()
+
+
+class Message:
+    """
+    A received MQTT message. The payload is decoded and parsed at most once,
+    and only when a handler asks for it, however many handlers get the
+    message.
+
+    Venus OS payloads are JSON like {"value": 12.5}, `value` is that value.
+    Payloads that aren't JSON, like the empty payload clearing a retained
+    topic, have `json` and `value` None.
+    """
+
+    __slots__ = ("topic", "raw", "_text", "_json", "_number")
+
+    def __init__(self, topic, raw):
+        self.topic = topic
+        self.raw = raw
+        self._text = None
+        self._json = _UNSET
+        self._number = _UNSET
+
+    def __bool__(self):
+        return bool(self.raw)
+
+    def __repr__(self):
+        return f"Message({self.topic!r}, {self.raw!r})"
+
+    @property
+    def text(self):
+        if self._text is None:
+            raw = self.raw
+            self._text = raw.decode() if isinstance(raw, (bytes, bytearray)) else str(raw)
+        return self._text
+
+    @property
+    def json(self):
+        if self._json is _UNSET:
+            try:
+                self._json = loads(self.raw) if self.raw else None
+            except ValueError:
+                self._json = None
+        return self._json
+
+    @property
+    def has_value(self):
+        data = self.json
+        return isinstance(data, dict) and "value" in data
+
+    @property
+    def value(self):
+        data = self.json
+        return data.get("value") if isinstance(data, dict) else None
+
+    @property
+    def number(self):
+        """
+        The value as a float, None if it isn't a number.
+        """
+        if self._number is _UNSET:
+            value = self.value
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                self._number = None
+            else:
+                self._number = float(value)
+        return self._number
+
+    @property
+    def number_or_nan(self):
+        number = self.number
+        return math.nan if number is None else number
@@ -1,60 +1,312 @@
 import logging
+import re
+import threading
+from string import Formatter
+
+from lazy_logger import LazyLogger
+
+_formatter = Formatter()
+
+# Ends the registry key of a replacement field like "a.b" or "a[0]"
+_FIELD_ACCESS = re.compile(r"[.\[]")
+
+# Marks a key missing from every scope of a lookup
+_MISSING = object()
 
-# TODO Can we change the data structure to be ONE?
 class Registry:
+    """
+    One store of the values templates are resolved with, in nested scopes:
+    the global scope (None), a scope per site and a scope per device below
+    its site. A lookup walks from the given scope up to the global one, so
+    the most specific value wins.
+
+    Rendered templates are cached per scope. A reverse index from every
+    (key, scope) to the cached results and consumers that used it lets add()
+    drop only the affected results, and tell which consumers, e.g. devices,
+    have to render again.
+
+    Values are added from the MQTT thread, the setup coordinator and timers.
+    Changes and rendering a result into the cache hold one lock, so a result
+    rendered from a value add() just replaced can't be cached after add()
+    dropped it. Cached results are read without it.
+    """
+
     def __init__(self, app):
         self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
 
-        # A global registry
-        self.registry = {}
-        # A special registry, with sub-registries per parent key
-        self.parent_registry = {}
-
-    def add(self, key, value, parent=None):
-        self.app.log(f"Add {key}->{value} to parent {parent}")
-        if parent:
-            if parent not in self.parent_registry:
-                self.parent_registry[parent] = {}
-            self.parent_registry[parent][key] = value
-        else:
-            self.registry[key] = value
+        # Scope -> its values, None is the global scope
+        self.values = {None: {}}
+        # Scope -> lookup chain, from the scope itself up to the global one
+        self.chains = {None: (None,)}
+
+        # Template string -> compiled Template
+        self.templates = {}
+        # (template string, scope) -> resolved string
+        self.results = {}
+        # (key, scope) -> result keys that used the key from that scope's chain
+        self.dependents = {}
+        # Result key -> consumers that resolved it
+        self.result_consumers = {}
+        # (key, scope) -> consumers that read the key directly with get()
+        self.key_consumers = {}
 
-    def resolve_placeholders(self, value, parent=None):
+        self.lock = threading.RLock()
+
+    def scope(self, name, parent=None):
         """
-        Resolve placeholders using registry or a specific parent registry.
+        Create a scope below a parent scope, if it doesn't exist yet.
+
+        :param name: the scope name, e.g. a VRM ID or "<vrm_id>/battery_512"
+        :param parent: the parent scope, None for the global scope
+        :return: the scope name
         """
-        if parent:
-            mapping = self.parent_registry.get(parent, {})
-        else:
-            mapping = self.registry
+        with self.lock:
+            if name not in self.chains:
+                self.values[name] = {}
+                self.chains[name] = (name,) + self.chains[parent]
+        return name
 
-        return self.resolve_placeholders_recursive(value, mapping)
+    def add(self, key, value, scope=None):
+        """
+        Set a value in a scope.
 
-    def resolve_placeholders_recursive(self, value, mapping=None):
+        :return: set of the consumers whose results used the key, empty if
+                 the value didn't change
         """
-        Resolving placeholders in a string using a mapper. This
-        one uses recursion to handle that string has lists or dicts
-        internally.
+        self.lazy_log.debug("Add %s->%s to scope %s", key, value, scope)
+
+        with self.lock:
+            mapping = self.values.get(scope)
+            if mapping is None:
+                mapping = self.values[self.scope(scope)]
+
+            if key in mapping and mapping[key] == value:
+                return set()
+
+            mapping[key] = value
+
+            # Drop only the cached results that used this key in this scope
+            consumers = set(self.key_consumers.get((key, scope), ()))
+            for result_key in self.dependents.get((key, scope), ()):
+                self.results.pop(result_key, None)
+                consumers.update(self.result_consumers.get(result_key, ()))
+
+        return consumers
+
+    def discard(self, consumer):
+        """
+        Forget a consumer, e.g. a removed device.
+        """
+        with self.lock:
+            for consumers in self.result_consumers.values():
+                consumers.discard(consumer)
+            for consumers in self.key_consumers.values():
+                consumers.discard(consumer)
+
+    def drop_scope(self, scope):
+        """
+        Remove a scope and the scopes below it, with their values and cached
+        results, e.g. of a removed device.
         """
-        mapping = mapping or self.registry
+        if scope is None:
+            return
+
+        with self.lock:
+            dropped = {name for name, chain in self.chains.items() if scope in chain}
+            for name in dropped:
+                self.values.pop(name, None)
+                self.chains.pop(name, None)
+
+            for result_key in [key for key in self.results if key[1] in dropped]:
+                self.results.pop(result_key, None)
+            for result_key in [key for key in self.result_consumers if key[1] in dropped]:
+                self.result_consumers.pop(result_key, None)
+
+            for index in (self.dependents, self.key_consumers):
+                for key in [key for key in index if key[1] in dropped]:
+                    index.pop(key, None)
+
+            # Results of the dropped scopes, indexed under their parent scopes
+            for result_keys in self.dependents.values():
+                for result_key in [key for key in result_keys if key[1] in dropped]:
+                    result_keys.discard(result_key)
+
+    def dump(self, root=None):
+        """
+        Copy of the values of a scope and all scopes below it, for a snapshot.
+
+        :return: dict of scope -> (parent scope, values)
+        """
+        with self.lock:
+            return {
+                scope: (chain[1] if len(chain) > 1 else None, dict(self.values[scope]))
+                for scope, chain in self.chains.items()
+                if root in chain
+            }
+
+    def load(self, state):
+        """
+        Restore the scopes of a dump. Values already set are kept.
+        """
+        with self.lock:
+            for scope, (parent, values) in sorted(state.items(), key=lambda item: len(str(item[0] or ""))):
+                if scope is not None:
+                    self.scope(scope, parent)
+                mapping = self.values[scope]
+                for key, value in values.items():
+                    mapping.setdefault(key, value)
+
+            self.results.clear()
 
+    def resolve(self, value, scope=None, consumer=None):
+        """
+        Resolve the placeholders of a string, or of all strings in a list or
+        dict, from a scope and its parents.
+
+        :param value: the string, list or dict
+        :param scope: the innermost scope, None for only the global scope
+        :param consumer: recorded as depending on the used keys, see add()
+        """
+        return self.resolve_placeholders_recursive(value, scope, consumer)
+
+    def resolve_placeholders_recursive(self, value, scope=None, consumer=None):
         if isinstance(value, str):
-            return value.format_map(SafeDict(mapping))
+            return self.render(value, scope, consumer)
 
         elif isinstance(value, list):
-            return [self.resolve_placeholders_recursive(v, mapping) for v in value]
+            return [self.resolve_placeholders_recursive(v, scope, consumer) for v in value]
 
         elif isinstance(value, dict):
-            return {k: self.resolve_placeholders_recursive(v, mapping) for k, v in value.items()}
+            return {k: self.resolve_placeholders_recursive(v, scope, consumer) for k, v in value.items()}
 
         else:
             # Numbers, booleans, None, etc
             return value
 
+    def render(self, template, scope, consumer=None):
+        result_key = (template, scope)
+
+        result = self.results.get(result_key)
+        if result is None:
+            compiled = self.compile(template)
+            if not compiled.keys:
+                return compiled.static
+
+            # Rendered and cached without an add() in between
+            with self.lock:
+                chain = self.chains[scope]
+                result = compiled.render(self.lookup, chain)
+                self.results[result_key] = result
+
+                for key in compiled.keys:
+                    for link in chain:
+                        self.dependents.setdefault((key, link), set()).add(result_key)
+
+        if consumer is not None:
+            with self.lock:
+                self.result_consumers.setdefault(result_key, set()).add(consumer)
+
+        return result
+
+    def compile(self, template):
+        compiled = self.templates.get(template)
+        if compiled is None:
+            compiled = self.templates[template] = Template(template)
+        return compiled
+
+    def get(self, key, scope=None, default=None, consumer=None):
+        """
+        The raw value of a key, from a scope and its parents.
+        """
+        with self.lock:
+            chain = self.chains[scope]
+            if consumer is not None:
+                for link in chain:
+                    self.key_consumers.setdefault((key, link), set()).add(consumer)
+
+            value = self.lookup(key, chain)
+        return default if value is _MISSING else value
+
+    def bind(self, template, bindings):
+        """
+        Fill in only the given placeholders of a template, keeping all others
+        for a later resolve. Not cached, the bindings aren't registry keys.
+
+        :param template: the template string
+        :param bindings: dict of placeholder -> value
+        """
+        return self.compile(template).render(lambda key, scopes: bindings.get(key, _MISSING), None)
+
+    def lookup(self, key, chain):
+        values = self.values
+        for scope in chain:
+            value = values[scope].get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+
+        return _MISSING
+
     def print_reg(self):
-        self.app.log(f"Registry: {self.registry}")
-        self.app.log(f"Parent Registry: {self.parent_registry}")
+        for scope, values in list(self.values.items()):
+            self.app.log(f"Registry {scope}: {values}")
+
+class Template:
+    """
+    A format string parsed once into literal text and replacement fields.
+    Fields missing from the registry are kept as placeholders.
+    """
+
+    __slots__ = ("parts", "keys", "static")
+
+    def __init__(self, template):
+        parts = []
+        keys = set()
+
+        for literal, field_name, format_spec, conversion in _formatter.parse(template):
+            if literal:
+                parts.append(literal)
+            if field_name is None:
+                continue
+
+            # "a.b" or "a[0]" depend on the registry key "a"
+            key = _FIELD_ACCESS.split(field_name, 1)[0]
+            keys.add(key)
+            parts.append((key, field_name, format_spec or "", conversion))
+
+        self.parts = tuple(parts)
+        self.keys = frozenset(keys)
+        # The rendered text of templates without fields
+        self.static = None if keys else "".join(parts)
+
+    def render(self, lookup, scopes):
+        out = []
+
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+
+            key, field_name, format_spec, conversion = part
+            value = lookup(key, scopes)
+
+            if value is _MISSING:
+                out.append(_placeholder(field_name, format_spec, conversion))
+                continue
+
+            if field_name != key:
+                value, _ = _formatter.get_field(field_name, (), {key: value})
+            if conversion:
+                value = _formatter.convert_field(value, conversion)
+
+            out.append(format(value, format_spec))
+
+        return "".join(out)
 
-class SafeDict(dict):
-    def __missing__(self, key):
-        return '{' + key + '}'
\ No newline at end of file
+def _placeholder(field_name, format_spec, conversion):
+    text = field_name
+    if conversion:
+        text += "!" + conversion
+    if format_spec:
+        text += ":" + format_spec
+    return "{" + text + "}"
@@ -1,54 +1,230 @@
+import _string
+from string import Formatter
+
+
 class SchemaError(Exception):
-    pass
+    """
+    A config doesn't match its schema. Carries every error found, not just
+    the first one.
+    """
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
 
 def _noop(*args, **kwargs):
     pass
 
+
+class _Context:
+    __slots__ = ("errors", "used", "declared", "local")
+
+    def __init__(self):
+        self.errors = []
+        # (path, name, local declarations) of every placeholder used by a
+        # checked field
+        self.used = []
+        # Placeholder names declared by the config itself
+        self.declared = set()
+        # Names declared by the current element of a scoped list, None
+        # outside of one
+        self.local = None
+
+
 class SchemaValidator:
-    @staticmethod
-    def validate(data, schema, *, path="root", log=None):
-        log = log or _noop
+    """
+    Validates configs against a schema dict. Every field maps to rules:
+
+    - type: expected type or tuple of types
+    - required: the field must be present and not null
+    - schema: schema of a dict value
+    - elements: schema of the dicts in a list value
+    - scoped: names declared inside an element of the list are only known
+      to that element, like the placeholders of an entity's expand
+    - choices: allowed values
+    - placeholders: the {placeholders} in the value must be declared
+    - references: the value is a placeholder name that must be declared
+    - declares: the value is a placeholder name the config declares, or a
+      tuple of formats like "{}_index" for the names derived from it
+
+    A schema is compiled once into a tree of closures, with the checks of
+    every field decided up front, and a validation collects all errors in
+    one pass. Optional fields set to null are treated as absent.
+    """
 
+    # id(schema) -> (schema, compiled validator), the schema is kept so its
+    # id can't be reused
+    _compiled = {}
+
+    @staticmethod
+    def compile(schema):
         if not isinstance(schema, dict):
             raise RuntimeError("Schema must be a dict")
-        SchemaValidator._validate_node(data, schema, path, log)
+
+        entry = SchemaValidator._compiled.get(id(schema))
+        if entry is None:
+            entry = SchemaValidator._compiled[id(schema)] = (schema, _compile_node(schema))
+        return entry[1]
+
+    @staticmethod
+    def errors(data, schema, *, path="root", names=()):
+        """
+        Validate a config.
+
+        :param data: the config
+        :param schema: the schema dict
+        :param path: name of the config in error messages
+        :param names: placeholder names declared outside the config
+        :return: list of error messages, empty if the config is valid
+        """
+        ctx = _Context()
+        SchemaValidator.compile(schema)(data, path, ctx)
+
+        known = ctx.declared.union(names)
+        for field_path, name, local in ctx.used:
+            if name not in known and (local is None or name not in local):
+                ctx.errors.append(f"{field_path} uses undeclared placeholder {{{name}}}")
+
+        return ctx.errors
 
     @staticmethod
-    def _validate_node(data, schema, path, log):
+    def validate(data, schema, *, path="root", names=(), log=None):
+        """
+        Validate a config, see errors().
+
+        :raises SchemaError: with all errors if the config is invalid
+        """
+        log = log or _noop
         log(f"Validating {path}")
 
+        errors = SchemaValidator.errors(data, schema, path=path, names=names)
+        if errors:
+            raise SchemaError(errors)
+
+
+def _compile_node(schema):
+    checks = {key: _compile_field(rules) for key, rules in schema.items()}
+    required = tuple(key for key, rules in schema.items() if rules.get("required"))
+
+    def check_node(data, path, ctx):
         if not isinstance(data, dict):
-            raise TypeError(f"{path} must be a dict")
+            ctx.errors.append(f"{path} must be a dict")
+            return
 
-        for key, rules in schema.items():
-            if rules.get("required") and key not in data:
-                raise ValueError(f"Missing required field {path}.{key}")
+        for key in required:
+            if data.get(key) is None:
+                ctx.errors.append(f"Missing required field {path}.{key}")
 
         for key, value in data.items():
-            if key not in schema:
-                raise ValueError(f"Unknown field {path}.{key}")
+            check = checks.get(key)
+            if check is None:
+                ctx.errors.append(f"Unknown field {path}.{key}")
+            elif value is not None:
+                check(value, f"{path}.{key}", ctx)
+
+    return check_node
+
+
+def _compile_field(rules):
+    steps = []
+
+    expected = rules.get("type")
+    if expected:
+        type_name = " or ".join(t.__name__ for t in expected) if isinstance(expected, tuple) else expected.__name__
+
+        def check_type(value, path, ctx):
+            if isinstance(value, expected):
+                return True
+            ctx.errors.append(f"{path} must be {type_name}, got {type(value).__name__}")
+            return False
+
+        steps.append(check_type)
+
+    choices = rules.get("choices")
+    if choices:
+        allowed = frozenset(choices)
+
+        def check_choice(value, path, ctx):
+            if value in allowed:
+                return True
+            ctx.errors.append(f"{path} has unknown value {value!r}")
+            return False
+
+        steps.append(check_choice)
+
+    if rules.get("placeholders"):
+        def collect_placeholders(value, path, ctx):
+            try:
+                ctx.used.extend((path, name, ctx.local) for name in _placeholders(value))
+            except ValueError as e:
+                ctx.errors.append(f"{path} has an invalid placeholder: {e}")
+            return True
+
+        steps.append(collect_placeholders)
+
+    if rules.get("references"):
+        def reference(value, path, ctx):
+            ctx.used.append((path, value, ctx.local))
+            return True
 
-            rules = schema[key]
-            expected_type = rules.get("type")
+        steps.append(reference)
 
-            if expected_type and not isinstance(value, expected_type):
-                raise TypeError(
-                    f"{path}.{key} must be {expected_type}, got {type(value)}"
-                )
+    declares = rules.get("declares")
+    if declares:
+        formats = ("{}",) if declares is True else tuple(declares)
 
-            if isinstance(value, dict) and "schema" in rules:
-                SchemaValidator._validate_node(
-                    value, rules["schema"], f"{path}.{key}", log
-                )
+        def declare(value, path, ctx):
+            declared = ctx.declared if ctx.local is None else ctx.local
+            declared.update(fmt.format(value) for fmt in formats)
+            return True
 
+        steps.append(declare)
+
+    if "schema" in rules:
+        check_node = _compile_node(rules["schema"])
+
+        def check_schema(value, path, ctx):
+            if isinstance(value, dict):
+                check_node(value, path, ctx)
+            return True
+
+        steps.append(check_schema)
+
+    if rules.get("elements"):
+        check_element = _compile_node(rules["elements"])
+        scoped = rules.get("scoped", False)
+
+        def check_elements(value, path, ctx):
             if isinstance(value, list):
-                elem_schema = rules.get("elements")
-                if elem_schema:
-                    for i, item in enumerate(value):
-                        if not isinstance(item, dict):
-                            raise TypeError(
-                                f"{path}.{key}[{i}] must be a dict"
-                            )
-                        SchemaValidator._validate_node(
-                            item, elem_schema, f"{path}.{key}[{i}]", log
-                        )
\ No newline at end of file
+                outer = ctx.local
+                for i, item in enumerate(value):
+                    if scoped:
+                        ctx.local = set()
+                    check_element(item, f"{path}[{i}]", ctx)
+                ctx.local = outer
+            return True
+
+        steps.append(check_elements)
+
+    if len(steps) == 1:
+        return steps[0]
+
+    steps = tuple(steps)
+
+    def check_field(value, path, ctx):
+        for step in steps:
+            if not step(value, path, ctx):
+                return
+
+    return check_field
+
+
+def _placeholders(value):
+    """
+    The names of the placeholders in a format string, e.g. batt_id for
+    "battery/{batt_id}/Soc".
+    """
+    for _, field, _, _ in Formatter().parse(value):
+        if field:
+            yield _string.formatter_field_name_split(field)[0]
@@ -1,3 +1,64 @@
+# Bump when the meaning of the schema changes without its structure changing
+SCHEMA_VERSION = 3
+
+# Placeholders filled by the pre-setup, usable in every config
+GLOBAL_PLACEHOLDERS = ('prefix', 'vrm_id', 'bus_id', 'phase_id')
+
+# Placeholders an entity expansion binds, from its `as` name
+EXPANSION_PLACEHOLDERS = ('{}', '{}_lower', '{}_index')
+
+# Home Assistant MQTT discovery components
+COMPONENTS = (
+    'alarm_control_panel', 'binary_sensor', 'button', 'camera', 'climate',
+    'cover', 'device_tracker', 'event', 'fan', 'humidifier', 'image',
+    'lawn_mower', 'light', 'lock', 'notify', 'number', 'scene', 'select',
+    'sensor', 'siren', 'switch', 'text', 'update', 'vacuum', 'valve',
+    'water_heater',
+)
+
+# Device classes of sensors and binary sensors
+DEVICE_CLASSES = (
+    # sensor
+    'apparent_power', 'aqi', 'area', 'atmospheric_pressure', 'battery',
+    'carbon_dioxide', 'carbon_monoxide', 'current', 'data_rate', 'data_size',
+    'date', 'distance', 'duration', 'energy', 'energy_distance',
+    'energy_storage', 'enum', 'frequency', 'gas', 'humidity', 'illuminance',
+    'irradiance', 'moisture', 'monetary', 'nitrogen_dioxide',
+    'nitrogen_monoxide', 'nitrous_oxide', 'ozone', 'ph', 'pm1', 'pm10',
+    'pm25', 'power', 'power_factor', 'precipitation',
+    'precipitation_intensity', 'pressure', 'reactive_energy',
+    'reactive_power', 'signal_strength', 'sound_pressure', 'speed',
+    'sulphur_dioxide', 'temperature', 'timestamp',
+    'volatile_organic_compounds', 'volatile_organic_compounds_parts',
+    'voltage', 'volume', 'volume_flow_rate', 'volume_storage', 'water',
+    'weight', 'wind_direction', 'wind_speed',
+    # binary_sensor
+    'battery_charging', 'cold', 'connectivity', 'door', 'garage_door',
+    'heat', 'light', 'lock', 'motion', 'moving', 'occupancy', 'opening',
+    'plug', 'presence', 'problem', 'running', 'safety', 'smoke', 'sound',
+    'tamper', 'update', 'vibration', 'window',
+)
+
+# Functions of derived sensors, see derived.DerivedPublisher
+DERIVED_FUNCTIONS = ('integral', 'mean', 'min', 'max', 'sum')
+
+# Home Assistant sensor state classes
+STATE_CLASSES = ('measurement', 'total', 'total_increasing')
+
+# A registry list to expand a template over
+EXPAND_SCHEMA = {
+    'over': {
+        'type': str,
+        'required': True,
+        'references': True
+    },
+    'as': {
+        'type': str,
+        'required': True,
+        'declares': EXPANSION_PLACEHOLDERS
+    }
+}
+
 HARDWARE_SCHEMA = {
     'type': {
         'type': str,
@@ -5,7 +66,8 @@ HARDWARE_SCHEMA = {
     },
     'discovery': {
         'type': str,
-        'required': False
+        'required': False,
+        'placeholders': True
     },
     'setup': {
         'type': list,
@@ -13,17 +75,28 @@ HARDWARE_SCHEMA = {
         'elements': {
             'topic': {
                 'type': str,
-                'required': True
+                'required': True,
+                'placeholders': True
             },
             'store': {
                 'type': str,
-                'required': True
+                'required': True,
+                'declares': True
+            },
+            'default': {
+                'type': (str, int, float),
+                'required': False
+            },
+            'timeout': {
+                'type': (int, float),
+                'required': False
             }
         }
     },
     'instance_id': {
         'type': str,
-        'required': True
+        'required': True,
+        'declares': True
     },
     'device_info': {
         'type': dict,
@@ -34,22 +107,28 @@ HARDWARE_SCHEMA = {
     },
     'entities': {
         'type': list,
+        # An entity's expand placeholders are only known to the entity
+        'scoped': True,
         'elements': {
             'name': {
                 'type': str,
                 'required': False,
+                'placeholders': True
             },
             'entity_id': {
                 'type': str,
                 'required': True,
+                'placeholders': True
             },
             'topic': {
                 'type': str,
-                'required': True
+                'required': True,
+                'placeholders': True
             },
             'device_class': {
                 'type': str,
-                'required': False
+                'required': False,
+                'choices': DEVICE_CLASSES
             },
             'unit_of_measurement': {
                 'type': str,
@@ -64,6 +143,105 @@ HARDWARE_SCHEMA = {
                 'required': False
             },
             'component': {
+                'type': str,
+                'required': False,
+                'choices': COMPONENTS
+            },
+            'deadband': {
+                'type': (int, float),
+                'required': False
+            },
+            'min_interval': {
+                'type': (int, float),
+                'required': False
+            },
+            'max_interval': {
+                'type': (int, float),
+                'required': False
+            },
+            'expand': {
+                'type': dict,
+                'required': False,
+                'schema': EXPAND_SCHEMA
+            },
+            'coalesce': {
+                'type': dict,
+                'required': False,
+                'schema': {
+                    'interval': {
+                        'type': (int, float),
+                        'required': True
+                    },
+                    'deadband': {
+                        'type': (int, float),
+                        'required': False
+                    }
+                }
+            }
+        }
+    },
+    'derived': {
+        'type': list,
+        'scoped': True,
+        'elements': {
+            'name': {
+                'type': str,
+                'required': False,
+                'placeholders': True
+            },
+            'entity_id': {
+                'type': str,
+                'required': True,
+                'placeholders': True
+            },
+            'function': {
+                'type': str,
+                'required': True,
+                'choices': DERIVED_FUNCTIONS
+            },
+            'sources': {
+                'type': list,
+                'required': True,
+                'elements': {
+                    'topic': {
+                        'type': str,
+                        'required': True,
+                        'placeholders': True
+                    },
+                    'expand': {
+                        'type': dict,
+                        'required': False,
+                        'schema': EXPAND_SCHEMA
+                    }
+                }
+            },
+            'window': {
+                'type': (int, float),
+                'required': False
+            },
+            'interval': {
+                'type': (int, float),
+                'required': False
+            },
+            'scale': {
+                'type': (int, float),
+                'required': False
+            },
+            'device_class': {
+                'type': str,
+                'required': False,
+                'choices': DEVICE_CLASSES
+            },
+            'state_class': {
+                'type': str,
+                'required': False,
+                'choices': STATE_CLASSES
+            },
+            'unit_of_measurement': {
+                'type': str,
+                'required': False
+            },
+            'icon': {
                 'type': str,
                 'required': False
             }
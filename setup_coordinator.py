@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+import traceback
+
+from lazy_logger import LazyLogger
+
+
+class SetupCoordinator:
+    """
+    Runs the setup steps of all devices concurrently on an asyncio loop in
+    its own thread.
+
+    Every step waits for its value with a deadline. When it passes, the value
+    is requested once with an R/ read request, and if that doesn't answer
+    either the step falls back to its `default`. A device is therefore always
+    ready after at most `timeout + read_timeout` seconds, no matter which
+    value is missing, and cold start time is bounded by the slowest device.
+
+    One coordinator serves all sites, every device is set up through the
+    broker and registry of its own site.
+    """
+
+    def __init__(self, app, timeout=10, read_timeout=5):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever,
+            name="victronlink-setup",
+            daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def setup_device(self, device, steps, site):
+        """
+        Schedule the setup of a device, thread safe. The site's publish_device
+        is called with the device, on the coordinator thread, once all steps
+        are done.
+
+        :param device: the device information
+        :param steps: the setup steps of the device config
+        :param site: the site of the device
+        """
+        return asyncio.run_coroutine_threadsafe(self.run_device(device, steps, site), self.loop)
+
+    async def run_device(self, device, steps, site):
+        start = time.monotonic()
+
+        try:
+            await asyncio.gather(*(self.run_step(device, step, site) for step in steps))
+
+            device['setup_latency'] = time.monotonic() - start
+            site.log(f"Setup of {device['id']} took {device['setup_latency']:.3f}s")
+
+            site.publish_device(device)
+        except Exception as e:
+            self.app.log(f"Error during setup of {device['id']}: {e}")
+            self.app.log(traceback.format_exc())
+
+    async def run_step(self, device, step, site):
+        mqtt_mgr = site.mqtt_mgr
+        feed = site.connection.entity_feed
+        topic = site.registry.resolve(step['topic'], device['scope'], device['scope'])
+        future = self.loop.create_future()
+
+        def receive(topic, message):
+            # Called on the MQTT thread
+            self.loop.call_soon_threadsafe(_resolve, future, message.value)
+
+        # Through the feed, setup values like ProductName are entity topics
+        # too, and their other consumers must keep the subscription
+        subscribed = topic in feed
+        feed.add(topic, receive)
+        if subscribed:
+            # No new SUBSCRIBE, so the broker won't send the retained value again
+            mqtt_mgr.publish(read_topic(topic), "")
+
+        try:
+            # Shield, so the future survives the first deadline
+            value = await asyncio.wait_for(asyncio.shield(future), step.get('timeout', self.timeout))
+        except asyncio.TimeoutError:
+            self.app.log(f"No value for {topic} yet, sending read request", level="WARNING")
+            mqtt_mgr.publish(read_topic(topic), "")
+
+            try:
+                value = await asyncio.wait_for(future, self.read_timeout)
+            except asyncio.TimeoutError:
+                value = step.get('default')
+
+                if value is None:
+                    self.app.log(f"Setup of {device['id']} got no {step['store']}, leaving it unset", level="WARNING")
+                    return
+
+                self.app.log(f"Setup of {device['id']} got no {step['store']}, using default {value}", level="WARNING")
+        finally:
+            feed.remove(topic, receive)
+
+        # Store the data in the registry
+        site.registry.add(step['store'], str(value), device['scope'])
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+def read_topic(topic):
+    """
+    The R/ read request topic of an N/ topic, e.g. victron/N/x/battery/0/Soc
+    becomes victron/R/x/battery/0/Soc.
+    """
+    return topic.replace("/N/", "/R/", 1) if "/N/" in topic else topic.replace("N/", "R/", 1)
@@ -0,0 +1,65 @@
+import os
+import pickle
+
+# Bump when the snapshot format changes
+SNAPSHOT_VERSION = 2
+
+
+class SnapshotStore:
+    """
+    Keeps the state learned from the GX devices in a file: the registries,
+    discovered devices and discovery digests. An app restart publishes from
+    the snapshot right away and reconciles with live MQTT afterwards,
+    instead of waiting for every pre-setup and setup value again.
+    """
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+        # Last written data, to skip writing an unchanged snapshot
+        self.written = None
+
+    def load(self):
+        """
+        :return: the snapshot dict, empty if there is no usable snapshot
+        """
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            version, state = pickle.loads(data)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.app.log(f"Ignoring unreadable snapshot: {e}", level="WARNING")
+            return {}
+
+        if version != SNAPSHOT_VERSION:
+            return {}
+
+        self.written = data
+        return state
+
+    def save(self, state):
+        """
+        Write the snapshot if it changed since the last write.
+
+        :param state: the snapshot dict
+        :return: True if it was written
+        """
+        data = pickle.dumps((SNAPSHOT_VERSION, state), protocol=pickle.HIGHEST_PROTOCOL)
+        if data == self.written:
+            return False
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            self.app.log(f"Could not write snapshot: {e}", level="WARNING")
+            return False
+
+        self.written = data
+        return True
@@ -0,0 +1,232 @@
+import json
+import math
+import threading
+import time
+
+from lazy_logger import LazyLogger
+
+
+class EntityState:
+    __slots__ = ("entity_id", "source_topic", "state_topic", "deadband", "min_interval", "max_interval",
+                 "value", "payload", "sent", "pending")
+
+    def __init__(self, entity_id, source_topic, state_topic):
+        self.entity_id = entity_id
+        self.source_topic = source_topic
+        self.state_topic = state_topic
+        self.deadband = 0
+        self.min_interval = 0
+        self.max_interval = None
+        # Last published value and payload, and when
+        self.value = None
+        self.payload = None
+        self.sent = -math.inf
+        # Significant payload held back by min_interval
+        self.pending = None
+
+
+class StatePublisher:
+    """
+    Republishes entity states on VictronLink's own state topics, so Home
+    Assistant only records significant changes instead of every Venus OS
+    update.
+
+    Per entity, a value is republished when it moved at least `deadband`
+    from the last published one, but not more often than every
+    `min_interval` seconds. If nothing was published for `max_interval`
+    seconds, the last value is published again as a heartbeat.
+    """
+
+    def __init__(self, app, mqtt_mgr, feed, prefix, defaults=None):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.mqtt_mgr = mqtt_mgr
+        self.feed = feed
+        self.prefix = prefix
+        self.defaults = defaults or {}
+
+        # Source topic -> states of the entities reading it
+        self.routes = {}
+        # entity_id -> EntityState
+        self.states = {}
+
+    def register(self, entity_id, source_topic, entity_config, device_id, value_template):
+        """
+        Route an entity through the publisher.
+
+        :param entity_id: the resolved entity id
+        :param source_topic: the resolved Venus OS topic
+        :param entity_config: the entity configuration, for its settings
+        :param device_id: the id of the entity's device
+        :param value_template: the entity's value template
+        :return: the state topic and value template Home Assistant should use
+        """
+        state = self.states.get(entity_id)
+        if state is None:
+            state = self.states[entity_id] = EntityState(entity_id, source_topic, f"{self.prefix}/{entity_id}")
+            self.routes.setdefault(source_topic, []).append(state)
+            self.feed.add(source_topic, self.handle)
+
+        for key in ('deadband', 'min_interval', 'max_interval'):
+            setattr(state, key, entity_config.get(key, self.defaults.get(key, getattr(state, key))))
+
+        return state.state_topic, value_template
+
+    def unregister(self, entity_id):
+        """
+        Stop republishing an entity, e.g. after it was removed from its config.
+        """
+        state = self.states.pop(entity_id, None)
+        if state is None:
+            return
+
+        routes = self.routes[state.source_topic]
+        routes.remove(state)
+        if not routes:
+            del self.routes[state.source_topic]
+            self.feed.remove(state.source_topic, self.handle)
+
+    def handle(self, topic, message):
+        now = time.monotonic()
+        payload = message.text
+        value = message.number
+
+        for state in self.routes.get(topic, ()):
+            if not self.significant(state, payload, value):
+                continue
+
+            if now - state.sent < state.min_interval:
+                state.pending = payload
+                continue
+
+            self.send(state, payload, value, now)
+
+    def significant(self, state, payload, value):
+        if state.payload is None:
+            return True
+        if value is None or state.value is None:
+            return payload != state.payload
+        return abs(value - state.value) >= state.deadband and value != state.value
+
+    def tick(self, kwargs=None):
+        """
+        Publish held back values and heartbeats, called every second.
+        """
+        now = time.monotonic()
+
+        for state in list(self.states.values()):
+            if state.pending is not None and now - state.sent >= state.min_interval:
+                self.send(state, state.pending, _value(state.pending), now)
+            elif state.max_interval and state.payload is not None and now - state.sent >= state.max_interval:
+                self.send(state, state.payload, state.value, now)
+
+    def send(self, state, payload, value, now):
+        state.pending = None
+        state.payload = payload
+        state.value = value
+        state.sent = now
+
+        # Retained, so HA has the state right after a restart
+        self.mqtt_mgr.publish(state.state_topic, payload, retain=True)
+        self.lazy_log.debug("Republished %s -> %s", state.entity_id, payload)
+
+
+class AggregateStatePublisher:
+    """
+    Publishes one JSON state document per device, keyed by entity id, once
+    per flush and only if something changed. Discovery points
+    every entity of the device at that topic, with a value template picking
+    its own field, so a device costs one message per flush instead of one
+    per entity update.
+
+    Entity attributes are deliberately not set from the document, HA would
+    record the whole document with every state change.
+    """
+
+    def __init__(self, app, mqtt_mgr, feed, prefix):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.mqtt_mgr = mqtt_mgr
+        self.feed = feed
+        self.prefix = prefix
+
+        # Source topic -> list of (device_id, entity_id)
+        self.routes = {}
+        # device_id -> {entity_id: value}
+        self.documents = {}
+        self.dirty = set()
+        # Messages update the documents while a timer flushes them
+        self.lock = threading.Lock()
+
+    def register(self, entity_id, source_topic, entity_config, device_id, value_template):
+        """
+        Add an entity to its device's document. See StatePublisher.register.
+        """
+        self.documents.setdefault(device_id, {})
+
+        route = (device_id, entity_id)
+        routes = self.routes.setdefault(source_topic, [])
+        if route not in routes:
+            routes.append(route)
+            self.feed.add(source_topic, self.handle)
+
+        # Let the entity's own template see its field as value_json.value
+        template = "{% set value_json = {'value': value_json.get('" + entity_id + "')} %}" + value_template
+
+        return f"{self.prefix}/{device_id}", template
+
+    def unregister(self, entity_id):
+        """
+        Remove an entity from its device's document.
+        """
+        with self.lock:
+            for topic, routes in list(self.routes.items()):
+                for route in [route for route in routes if route[1] == entity_id]:
+                    routes.remove(route)
+                    device_id = route[0]
+                    if self.documents.get(device_id, {}).pop(entity_id, None) is not None:
+                        self.dirty.add(device_id)
+                if not routes:
+                    del self.routes[topic]
+                    self.feed.remove(topic, self.handle)
+
+    def handle(self, topic, message):
+        if not message.has_value:
+            return
+        value = message.value
+
+        with self.lock:
+            for device_id, entity_id in self.routes.get(topic, ()):
+                document = self.documents[device_id]
+                if entity_id not in document or document[entity_id] != value:
+                    document[entity_id] = value
+                    self.dirty.add(device_id)
+
+    def flush(self, kwargs=None):
+        """
+        Publish the documents of all devices that changed since the last flush.
+        """
+        with self.lock:
+            payloads = [
+                (device_id, json.dumps(self.documents[device_id], separators=(",", ":")))
+                for device_id in self.dirty
+            ]
+            self.dirty.clear()
+
+        for device_id, payload in payloads:
+            # Retained, so HA has the state right after a restart
+            self.mqtt_mgr.publish(f"{self.prefix}/{device_id}", payload, retain=True)
+            self.lazy_log.debug("Published state of %s", device_id)
+
+
+def _value(payload):
+    """
+    The numeric value of a Venus OS payload, None if it has none.
+    """
+    try:
+        value = json.loads(payload)["value"]
+    except (ValueError, TypeError, KeyError):
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
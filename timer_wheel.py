@@ -0,0 +1,88 @@
+import time
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel of deadlines, one slot per `resolution` seconds.
+    Moving a deadline later, the common case of a key seen again, only
+    updates a dict: the key stays in its slot and is re-hashed when the
+    wheel reaches that slot. advance() only visits the slots passed since
+    the last call, however many keys there are.
+
+    Deadlines are time.monotonic() values. Keys expire at most one
+    resolution late.
+    """
+
+    def __init__(self, resolution=1, slots=512):
+        self.resolution = resolution
+        self.size = slots
+        self.slots = [set() for _ in range(slots)]
+        # key -> deadline
+        self.deadlines = {}
+        # key -> index of the slot it is in
+        self.slot_of = {}
+        # Last tick advance() processed
+        self.position = self.tick(time.monotonic())
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def tick(self, t):
+        return int(t // self.resolution)
+
+    def schedule(self, key, deadline):
+        """
+        Set the deadline of a key, adding it if needed.
+        """
+        current = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+
+        if current is not None and deadline >= current:
+            # Re-hashed lazily when the wheel reaches its slot
+            return
+
+        if current is not None:
+            self.slots[self.slot_of[key]].discard(key)
+        self.place(key, deadline)
+
+    def cancel(self, key):
+        if self.deadlines.pop(key, None) is not None:
+            self.slots[self.slot_of.pop(key)].discard(key)
+
+    def place(self, key, deadline):
+        # Never behind the wheel, a passed slot is only visited a rotation later
+        index = max(self.tick(deadline), self.position + 1) % self.size
+        self.slots[index].add(key)
+        self.slot_of[key] = index
+
+    def advance(self, now):
+        """
+        Turn the wheel to now.
+
+        :return: list of the expired keys, which are removed
+        """
+        current = self.tick(now)
+        expired = []
+
+        # One rotation visits every slot
+        for tick in range(self.position + 1, min(current, self.position + self.size) + 1):
+            index = tick % self.size
+            slot = self.slots[index]
+            for key in list(slot):
+                deadline = self.deadlines[key]
+                if deadline <= now:
+                    slot.discard(key)
+                    del self.deadlines[key]
+                    del self.slot_of[key]
+                    expired.append(key)
+                else:
+                    # Moved later since it was placed, or a rotation ahead
+                    slot.discard(key)
+                    self.position = tick
+                    self.place(key, deadline)
+
+        self.position = max(self.position, current)
+        return expired
@@ -0,0 +1,158 @@
+import threading
+
+
+class _Node:
+    __slots__ = ("children", "plus", "hash", "subscription")
+
+    def __init__(self):
+        self.children = {}
+        self.plus = None
+        self.hash = None
+        # The subscription filter ending at this node, if any
+        self.subscription = None
+
+
+class TopicIndex:
+    """
+    MQTT topic tree index. Every subscription filter is stored as a path of
+    levels, with "+" and "#" as dedicated child nodes, so matching a topic
+    only walks the levels of that topic instead of testing every filter.
+
+    Match results are cached per topic. Venus OS publishes a fixed set of
+    topics, so after warm-up both hits and misses cost a single lookup.
+    """
+
+    def __init__(self, cache_size=4096):
+        self.root = _Node()
+        self.cache = {}
+        self.cache_size = cache_size
+        # Bumped by every change of the tree. A match computed while the tree
+        # changed on another thread isn't cached, it may miss the new filter
+        self.generation = 0
+        # Orders storing a match against the cache clear of a change
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(1 for _ in self._walk(self.root))
+
+    def add(self, sub):
+        node = self.root
+
+        for level in sub.split("/"):
+            if level == "+":
+                if node.plus is None:
+                    node.plus = _Node()
+                node = node.plus
+            elif level == "#":
+                if node.hash is None:
+                    node.hash = _Node()
+                node = node.hash
+            else:
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _Node()
+                node = child
+
+        with self.lock:
+            node.subscription = sub
+            self.generation += 1
+            self.cache.clear()
+
+    def remove(self, sub):
+        """
+        Remove a subscription filter, pruning nodes left without children.
+
+        :param sub: the subscription filter
+        :return: True if the filter was indexed
+        """
+        path = []
+        node = self.root
+
+        for level in sub.split("/"):
+            if level == "+":
+                child = node.plus
+            elif level == "#":
+                child = node.hash
+            else:
+                child = node.children.get(level)
+
+            if child is None:
+                return False
+
+            path.append((node, level, child))
+            node = child
+
+        if node.subscription is None:
+            return False
+
+        with self.lock:
+            node.subscription = None
+            self.generation += 1
+            self.cache.clear()
+
+        # Prune empty branches bottom-up
+        for parent, level, child in reversed(path):
+            if child.subscription is not None or child.children or child.plus or child.hash:
+                break
+            if level == "+":
+                parent.plus = None
+            elif level == "#":
+                parent.hash = None
+            else:
+                del parent.children[level]
+
+        return True
+
+    def match(self, topic):
+        """
+        Find all subscription filters matching a topic.
+
+        :param topic: the topic of a received message
+        :return: a tuple of matching subscription filters, empty if none
+        """
+        cached = self.cache.get(topic)
+        if cached is not None:
+            return cached
+
+        generation = self.generation
+        levels = topic.split("/")
+        matches = []
+        # Wildcards at the first level don't match topics starting with "$"
+        self._match(self.root, levels, 0, matches, topic.startswith("$"))
+        result = tuple(matches)
+
+        # Only misses take the lock
+        with self.lock:
+            if generation == self.generation:
+                if len(self.cache) >= self.cache_size:
+                    self.cache.clear()
+                self.cache[topic] = result
+
+        return result
+
+    def _match(self, node, levels, i, matches, system):
+        if not system and node.hash is not None and node.hash.subscription is not None:
+            # "#" also matches the parent level, "a/#" matches "a"
+            matches.append(node.hash.subscription)
+
+        if i == len(levels):
+            if node.subscription is not None:
+                matches.append(node.subscription)
+            return
+
+        child = node.children.get(levels[i])
+        if child is not None:
+            self._match(child, levels, i + 1, matches, False)
+
+        if not system and node.plus is not None:
+            self._match(node.plus, levels, i + 1, matches, False)
+
+    def _walk(self, node):
+        if node.subscription is not None:
+            yield node.subscription
+        for child in node.children.values():
+            yield from self._walk(child)
+        if node.plus is not None:
+            yield from self._walk(node.plus)
+        if node.hash is not None:
+            yield from self._walk(node.hash)
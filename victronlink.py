@@ -1,377 +1,289 @@
 import appdaemon.plugins.hass.hassapi as hass
-import paho.mqtt.client as mqtt
 import json
-import inspect
-import re
-import itertools
+import os
 import traceback
-from string import Formatter
-from mqtt_manager import MqttManager
-from registry import Registry
 from config_parser import ConfigParser
-import json
+from lazy_logger import LazyLogger
+from setup_coordinator import SetupCoordinator
+from registry import Registry
+from metrics import Metrics, diagnostic_entities
+from gx_site import Site, Connection
+from vrm_discovery import VrmDiscovery
+from snapshot import SnapshotStore
+from availability import AvailabilityTracker
 
 # TODO Prefix victron is set in the HA MQTT addon by me
 # TODO Maybe listen directly to the victron MQTT instead?
-# TODO Handle number of phases dynamically instead of always exposong L1,L2,L3
 class VictronLink(hass.Hass):
 
     def initialize(self):
-
-        self.topic_handlers = {}
-        self.registry = Registry(app=self)
-        self.devices = {}
-
-        # TODO Better format to parse the result into mappers automatically
-        self.pre_setup_config = [
-            {
-                'name': "bus_number",
-                'topic': "victron/N/{vrm_id}/system/0/VebusInstance",
-                'handler': self.handle_registry,
-                'store': 'bus_id'
-            },
-            {
-                'name': "number_of_phases",
-                'topic': "victron/N/{vrm_id}/system/0/Ac/Consumption/NumberOfPhases",
-                'handler': self.handle_phases,
-                'store': 'phase_id'
-            }
-        ]
-
-        parser = ConfigParser(app=self, folder="hardware")
-        hardware_configs = parser.load_all()
-
-        # TODO vrm_id from config file
-        self.config = {
-            'vrm_id': "c0619ab8d038",
-            'devices': hardware_configs
-        }
-
-        # Used to map tags to actual values
-        self.registry.add('vrm_id', self.config['vrm_id'])
-
-        mqtt_cfg = self.args.get("mqtt", {})
-        self.mqtt_mgr = MqttManager(
-            app=self, 
-            host="core-mosquitto", 
-            port=1883, 
-            username=mqtt_cfg.get("username"),
-            password=mqtt_cfg.get("password")
+        self.lazy_log = LazyLogger(
+            self,
+            sample_interval=self.args.get("log_sample_interval"),
+            sample_level=self.args.get("log_sample_level", "INFO")
         )
-        self.mqtt_mgr.connect(self.on_connect)
+        self.metrics = Metrics()
 
-    def on_connect(self, rc):
-        if rc == 0:
-            self.log("Connected successfully")
-            self.setup()
-        else:
-            self.log(f"Failed to connect, return code {rc}")
+        self.config_parser = ConfigParser(app=self, folder="hardware", cache=self.args.get("config_cache", True))
+        # Shared by all sites, hot reloads update it in place
+        self.device_configs = self.config_parser.load_all()
 
-    def setup(self):
-        self.log("Running setup...")
-        self.pre_setup()
+        # One registry for all sites, with a scope per site and device
+        self.registry = Registry(self)
 
-    def pre_setup(self):
+        self.setup_coordinator = SetupCoordinator(
+            app=self,
+            timeout=self.args.get("setup_timeout", 10),
+            read_timeout=self.args.get("setup_read_timeout", 5)
+        )
+        self.setup_coordinator.start()
+
+        # Marks devices offline that stopped publishing
+        self.availability = None
+        if self.args.get("availability", True):
+            self.availability = AvailabilityTracker(app=self, timeout=self.args.get("availability_timeout", 300))
+
+        # Broker (host, port, username) -> Connection
+        self.connections = {}
+        self.sites = []
+        for site_args in self.site_args():
+            self.add_site(site_args)
+
+        # Rediscover hot-plugged devices on a timer or by firing the event
+        self.listen_event(self.handle_rediscover_event, "victronlink_rediscover")
+        rediscover_interval = self.args.get("rediscover_interval")
+        if rediscover_interval:
+            self.run_every(self.handle_rediscover_timer, f"now+{rediscover_interval}", rediscover_interval)
+
+        metrics_interval = self.args.get("metrics_interval", 60)
+        if metrics_interval:
+            self.run_every(self.publish_metrics, f"now+{metrics_interval}", metrics_interval)
+
+        # What the GX devices told us, so a restart can publish right away
+        self.snapshot_store = None
+        if self.args.get("snapshot", True):
+            base = os.path.dirname(os.path.abspath(__file__))
+            self.snapshot_store = SnapshotStore(self, os.path.join(base, ".cache", "snapshot.pickle"))
+            self.restore_snapshot()
+
+            snapshot_interval = self.args.get("snapshot_interval", 60)
+            self.run_every(self.save_snapshot, f"now+{snapshot_interval}", snapshot_interval)
+
+        # Pick up edits of the hardware configs without restarting the app
+        config_reload_interval = self.args.get("config_reload_interval", 10)
+        if config_reload_interval:
+            self.run_every(self.check_configs, f"now+{config_reload_interval}", config_reload_interval)
+
+        for connection in self.connections.values():
+            connection.connect()
+
+    def site_args(self):
         """
-        Run pre-setup, fetching the data needed for most other topic, data
-        like the VRM ID.
+        The settings of every site. Without a `sites` list the app bridges a
+        single site.
+
+        :return: list of dicts, the app settings overridden by the site's
         """
+        sites = self.args.get("sites")
+        if not sites:
+            sites = [{'vrm_id': self.args.get("vrm_id", "auto")}]
 
-        try:
-            self.log("Running pre-setup. Setting up one-shot subscribers...")
-            
-            # Create a set, keeping track of all the pre-setup calls
-            self.pre_setup_pending = set()
-            for config in self.pre_setup_config:
-                # Keep track of what's left to fetch
-                self.pre_setup_pending.add(config['store'])
-                self.mqtt_mgr.subscribe_one_shot(config['topic'].format(vrm_id=self.config['vrm_id']), config['handler'], {'store': config['store']})
+        args = {key: value for key, value in self.args.items() if key != "sites"}
+        return [dict(args, **site) for site in sites]
 
-        except Exception as e:
-            self.log(f"Error during pre-setup: {e}")
-            self.log(traceback.format_exc())
+    def add_site(self, args):
+        """
+        Create a site, and the connection to its broker unless another site
+        already uses the same one. A site with vrm_id "auto" is created for
+        every VRM ID found on the broker instead.
 
-    def extract_wildcards(self, sub, topic):
-        sub_parts = sub.split("/")
-        topic_parts = topic.split("/")
+        :param args: the site settings, see site_args
+        :return: the site, None for "auto"
+        """
+        mqtt_cfg = args.get("mqtt", {})
+        host = mqtt_cfg.get("host", "core-mosquitto")
+        port = mqtt_cfg.get("port", 1883)
+        username = mqtt_cfg.get("username")
+
+        key = (host, port, username)
+        connection = self.connections.get(key)
+        if connection is None:
+            connection = self.connections[key] = Connection(
+                app=self,
+                host=host,
+                port=port,
+                username=username,
+                password=mqtt_cfg.get("password"),
+                metrics=self.metrics,
+                availability=self.availability
+            )
 
-        if len(sub_parts) != len(topic_parts):
+        if args.get('vrm_id', "auto") == "auto":
+            if connection.vrm_discovery is None:
+                connection.vrm_args = args
+                connection.vrm_discovery = VrmDiscovery(
+                    app=self,
+                    mqtt_mgr=connection.mqtt_mgr,
+                    on_found=lambda vrm_id: self.vrm_id_found(connection, args, vrm_id),
+                    prefix=args.get("topic_prefix", "victron"),
+                    timeout=args.get("vrm_discovery_timeout", 5),
+                    hints=args.get("vrm_id_hints", [])
+                )
             return None
 
-        values = []
+        site = Site(
+            app=self,
+            vrm_id=args['vrm_id'],
+            connection=connection,
+            device_configs=self.device_configs,
+            setup_coordinator=self.setup_coordinator,
+            registry=self.registry,
+            availability=self.availability,
+            args=args
+        )
+        self.sites.append(site)
+        self.log(f"Added site {site.vrm_id} on {host}:{port}")
+
+        return site
 
-        for s, t in zip(sub_parts, topic_parts):
-            if s == "#":
-                # "#" absorbs the rest of the topic
-                values.append("/".join(topic_parts[len(values):]))
-                return values
-            elif s == "+":
-                values.append(t)
-            elif s != t:
-                return None
+    def vrm_id_found(self, connection, args, vrm_id):
+        """
+        Add a site for a VRM ID found on a broker, unless it already has one.
+        """
+        if any(site.vrm_id == vrm_id for site in connection.sites):
+            return
 
-        return values
+        site = self.add_site(dict(args, vrm_id=vrm_id))
+        if connection.connected_at is not None:
+            site.on_connect()
 
-    def post_setup(self):
+    def restore_snapshot(self):
         try:
-            self.log("Running post-setup")
-            self.discover_devices()
+            state = self.snapshot_store.load()
+
+            for key, discovery_state in state.get('connections', {}).items():
+                connection = self.connections.get(key)
+                if connection is not None:
+                    connection.discovery.restore(discovery_state)
+
+            for vrm_id, site_state in state.get('sites', {}).items():
+                site = next((site for site in self.sites if site.vrm_id == vrm_id), None)
+                if site is None:
+                    # A site found by VRM ID discovery last time
+                    connection = self.connections.get(site_state['connection'])
+                    if connection is None or connection.vrm_args is None:
+                        continue
+                    site = self.add_site(dict(connection.vrm_args, vrm_id=vrm_id))
+
+                site.restore(site_state)
         except Exception as e:
-            self.log(f"Error during post-setup: {e}")
+            self.log(f"Error restoring snapshot: {e}")
             self.log(traceback.format_exc())
 
-    def discover_devices(self):
+    def save_snapshot(self, kwargs=None):
         try:
-            self.log("Discover devices")
-            for device_config in self.config['devices']:
-                self.log(f"Discover device {device_config['type']}")
-                discovery_topic = device_config.get("discovery")
-                if discovery_topic:
-                    self.mqtt_mgr.subscribe(self.registry.resolve_placeholders(discovery_topic), self.handle_discovery, device_config)
-                else:
-                    # Device has no discovery, probably because it can't have multiple instances
-                    # Just set instance to 0 and add it directly
-                    instance = 0
-                    device_type = device_config['type']
-                    if self.add_device(device_type, instance, device_config):
-                        self.log(f"Added new {device_type} device of instance {instance}")
-                    
+            state = {
+                'connections': {
+                    key: connection.discovery.snapshot() for key, connection in self.connections.items()
+                },
+                'sites': {
+                    site.vrm_id: dict(site.snapshot(), connection=site.connection.key) for site in self.sites
+                }
+            }
+            if self.snapshot_store.save(state):
+                self.lazy_log.debug("Saved snapshot")
         except Exception as e:
-            self.log(f"Error during discover devices: {e}")
+            self.log(f"Error saving snapshot: {e}")
             self.log(traceback.format_exc())
 
-    def handle_discovery(self, topic, payload, userdata):
-        device_config = userdata
-        device_type = device_config['type']
-
-        # Find instance id from the first wild card
-        wilds = self.extract_wildcards(self.registry.resolve_placeholders(device_config['discovery']), topic)
-
-        if wilds:
-            instance = wilds[0]
-            
-            if self.add_device(device_type, instance, device_config):
-                self.log(f"Added new {device_type} device of instance {instance}")
-
-    def add_device(self, dev_type, instance, config):
-        """
-        Receive device discovery message. Add a new device if this was the first
-        time it sends the message.
-
-        :param dev_type: the device type
-        :param instance: the instance id of the device
-        :param config: the attached device configuration
-        """
-
-        # Create type bucket if missing
-        if dev_type not in self.devices:
-            self.devices[dev_type] = {}
-
-        # Add only if new
-        if instance not in self.devices[dev_type]:
-            device = {
-                'id': f"{dev_type}_{instance}",
-                'instance': instance,
-                'dev_type': dev_type,
-                'config': config
-            }
-            self.devices[dev_type][instance] = device
-            # TODO Handle none instance devices (system)
-            self.registry.add(config['instance_id'], instance, device['id'])
-            
-            self.device_setup(device)
-            
-            return True
-
-        return False
+    def check_configs(self, kwargs):
+        try:
+            for old_config, new_config in self.config_parser.poll():
+                self.reload_config(old_config, new_config)
+        except Exception as e:
+            self.log(f"Error reloading configs: {e}")
+            self.log(traceback.format_exc())
 
-    def device_setup(self, device):
+    def reload_config(self, old_config, new_config):
         """
-        Run device setup. This will fetch device specific data needed for
-        topics and Home Assistant device info.
+        Swap a changed hardware config in the shared config list and apply it
+        to every site.
 
-        :param device: the device information
+        :param old_config: the config before the change, None if it is new
+        :param new_config: the config after the change, None if it was removed
         """
-
-        self.log(f"Device setup {device['config']['type']}[{device['instance']}]")
-
-        config = device['config']
-        setup_steps = config.get('setup', [])
-        device['setup_steps'] = len(setup_steps)
-
-        if not setup_steps:
-            self.log(f"No setup steps for {config['type']}[{device['instance']}], publishing immediately.")
-            self.publish_device(device)
+        if old_config == new_config:
             return
 
-        for step in config['setup']:
-            topic = self.registry.resolve_placeholders(self.registry.resolve_placeholders(step['topic']), device['id'])
-
-            self.mqtt_mgr.subscribe_one_shot(
-                topic, 
-                self.setup_receive, 
-                {
-                    'store': step['store'],
-                    'device': device
-                }
-            )
-
-    def setup_receive(self, topic, payload, userdata):
-        """
-        Receive method for the device setup MQTT information. This information
-        will be saved into the registry for later usage.
-
-        :param topic: the topic that received the message
-        :param payload: the payload of the received message
-        :param userdata: the userdata of the call
-        """
-
-        store = userdata['store']
-        device = userdata['device']
+        configs = self.device_configs
+        if old_config is not None:
+            configs[:] = [config for config in configs if config is not old_config]
+        if new_config is not None:
+            configs.append(new_config)
 
-        # Extract the message value
-        data = json.loads(payload)
-        value = str(data["value"])
+        for site in self.sites:
+            try:
+                site.reload_config(old_config, new_config)
+            except Exception as e:
+                site.log(f"Error reloading config: {e}")
+                site.log(traceback.format_exc())
 
-        # Store the data in the registry
-        self.registry.add(store, value, device['id'])
+    def handle_rediscover_event(self, event_name, data, kwargs):
+        for site in self.sites:
+            site.rediscover()
 
-        device['setup_steps'] -= 1
+    def handle_rediscover_timer(self, kwargs):
+        for site in self.sites:
+            site.rediscover()
 
-        # If we have receieved all setup data for the device, publish it
-        if device['setup_steps'] == 0:
-            self.publish_device(device)
-
-    def publish_device(self, device):
+    def publish_metrics(self, kwargs):
         """
-        Publish the device. Will resolve all needed device information and then
-        publish it to the MQTT bus where Home Assistant will pick it up.
-
-        :param device: the device information
+        Publish the metrics snapshot, and the diagnostic sensors showing it on
+        the bridge's own device. The bridge is published with the first site.
         """
+        if not self.sites:
+            return
 
-        self.log(f"Publish device: {device['id']}")
-
-        device_config = device['config']
-
-        self.resolve_device_info(device)
-
-        # Publish all the entities of this device to Home Assistant, it will
-        # set up HA to listen to them directly
-        for entity_config in device_config['entities']:
-            self.publish_entity_discover(entity_config, device)
-
-    # Generic data store for dynamic values
-    def handle_registry(self, topic, payload, userdata):
-        data = json.loads(payload)
-        value = int(data["value"])
-
-        self.registry.add(userdata['store'], value)
-
-        self.remove_pre_setup_pending(userdata['store'])
-
-    # TODO Can we do this generically instead?
-    def handle_phases(self, topic, payload, userdata):
-        data = json.loads(payload)
-        phase_count = int(data["value"])
-        
-        # Generate phase IDs like L1, L2, L3, ... based on phase_count
-        self.registry.add('phase_id', [f"L{i+1}" for i in range(phase_count)])
-
-        self.remove_pre_setup_pending(userdata['store'])
-
-    def remove_pre_setup_pending(self, store):
-        self.log(f"Pre setup pending before: {self.pre_setup_pending}")
-        self.pre_setup_pending.remove(store)
-
-        if len(self.pre_setup_pending) == 0:
-            self.post_setup()
-
-    def resolve_device_info(self, device):
-        device['device_info'] = self.registry.resolve_placeholders(
-            self.registry.resolve_placeholders(device['config']['device_info'],
-            device['id'])
-        )
-
-        self.log(f"New device info: {device['device_info']}")
-
-    def publish_entity_discover(self, entity_config, device):
         try:
-            # Use the entity's value_template if it exists, otherwise default to "{{ value_json.value }}"
-            value_template = entity_config.get('value_template', "{{ value_json.value }}")
-            # default to sensor
-            component = entity_config.get('component', 'sensor') 
-
-            device_info = device['device_info']
-
-            self.log(f"Publishing device info: {device_info}", level="DEBUG")
-
-            entity_id = self.registry.resolve_placeholders(self.registry.resolve_placeholders(entity_config['entity_id']), device['id'])
-            state_topic = self.registry.resolve_placeholders(self.registry.resolve_placeholders(entity_config['topic']), device['id'])
-            name = self.registry.resolve_placeholders(self.registry.resolve_placeholders(entity_config['name']), device['id'])
-
-            self.publish_discovery(
-                entity_id=entity_id,
-                state_topic=state_topic,
-                name=name,
-                device_class=entity_config.get('device_class'),
-                unit_of_measurement=entity_config.get('unit_of_measurement'),
-                icon=entity_config.get('icon'),
-                device=device_info,
-                component=component,
-                value_template=value_template
+            site = self.sites[0]
+            vrm_id = site.vrm_id
+            state_topic = f"victronlink/{vrm_id}/metrics"
+            bridge_id = f"victronlink_{vrm_id}"
+
+            connections = self.connections.values()
+            self.metrics.gauge("discovery_queue", sum(c.discovery.depth for c in connections))
+            self.metrics.gauge("dispatch_queue", sum(c.mqtt_mgr.queue_depth for c in connections))
+            snapshot = self.metrics.snapshot()
+
+            bridge_info = {
+                'identifiers': [bridge_id],
+                'name': f"VictronLink Bridge [{vrm_id}]",
+                'manufacturer': "VictronLink",
+                'model': "AppDaemon bridge"
+            }
+
+            # Unchanged sensor configs are skipped by the discovery digests
+            site.discovery.publish_device(
+                bridge_id, bridge_info,
+                diagnostic_entities(snapshot, state_topic, bridge_id, site.connection.availability_topics())
             )
+            site.mqtt_mgr.publish(state_topic, json.dumps(snapshot))
         except Exception as e:
-            self.log(f"Error during publish entity discover: {e}")
+            self.log(f"Error publishing metrics: {e}")
             self.log(traceback.format_exc())
 
-    def publish_discovery(self, entity_id, state_topic, name, device_class=None,
-                        unit_of_measurement=None, icon=None, device=None,
-                        component="sensor", value_template=None):
-        """
-        Publish a Home Assistant MQTT discovery message for any entity.
-
-        :param entity_id: unique identifier for this entity
-        :param state_topic: the topic HA should subscribe to for state updates
-        :param name: human-readable name
-        :param device_class: HA device class (optional)
-        :param unit_of_measurement: unit of measurement (optional)
-        :param icon: mdi icon (optional)
-        :param device: dict with device info (optional)
-        :param component: HA component type, default "sensor"
-        :param value_template: optional value_template string
-        """
-        discovery_topic = f"homeassistant/{component}/{entity_id}/config"
-
-        payload = {
-            "name": name,
-            "state_topic": state_topic,
-            "unique_id": entity_id,
-        }
-
-        if device_class:
-            payload["device_class"] = device_class
-        if unit_of_measurement:
-            payload["unit_of_measurement"] = unit_of_measurement
-        if icon:
-            payload["icon"] = icon
-        if value_template:
-            payload["value_template"] = value_template
-        if device:
-            payload["device"] = device
-
-        # Convert to JSON string
-        payload_json = json.dumps(payload)
-
-        # Publish with retain=True so HA remembers it after restart
-        self.mqtt_mgr.client.publish(discovery_topic, payload_json, retain=True)
-        self.log(f"Published discovery for {entity_id} -> {discovery_topic}")
-
     def terminate(self):
+        if self.snapshot_store:
+            self.save_snapshot()
+
         self.log("Shutting down MQTT client")
-        try:
-            # TODO Expose helpers instead?
-            self.mqtt_mgr.client.loop_stop()
-            self.mqtt_mgr.client.disconnect()
-        except Exception as e:
-            self.log(f"Error stopping MQTT client: {e}")
+        for site in self.sites:
+            site.stop()
+        self.setup_coordinator.stop()
+        if self.availability:
+            self.availability.stop()
+        for connection in self.connections.values():
+            try:
+                connection.disconnect()
+            except Exception as e:
+                self.log(f"Error stopping MQTT client: {e}")
@@ -0,0 +1,86 @@
+import traceback
+
+from lazy_logger import LazyLogger
+
+
+class VrmDiscovery:
+    """
+    Finds the VRM portal IDs of the GX devices on a broker from
+    {prefix}/N/+/system/0/Serial, so the VRM ID doesn't have to be
+    configured.
+
+    If no serial arrived `timeout` seconds after start(), a keepalive is sent
+    to every hinted portal ID to wake the GX up. Without hints there is
+    nothing to address, the GX only answers read requests and keepalives on
+    its own portal ID. The subscription stays, so a swapped GX shows up too.
+    """
+
+    def __init__(self, app, mqtt_mgr, on_found, prefix="victron", timeout=5, hints=()):
+        self.app = app
+        self.lazy_log = LazyLogger.for_app(app)
+        self.mqtt_mgr = mqtt_mgr
+        self.on_found = on_found
+        self.prefix = prefix
+        self.timeout = timeout
+        self.hints = list(hints)
+
+        self.topic = f"{prefix}/N/+/system/0/Serial"
+        # Level of the portal ID in the topic
+        self.level = len(prefix.split("/")) + 1
+        self.found = set()
+        self.timer = None
+
+    def start(self):
+        """
+        Subscribe to the serial topic, called on every connect.
+        """
+        self.app.log(f"Discovering VRM IDs on {self.topic}")
+        self.mqtt_mgr.subscribe(self.topic, self.handle, None)
+
+        self.cancel()
+        if self.timeout:
+            self.timer = self.app.run_in(self.nudge, self.timeout)
+
+    def cancel(self):
+        if self.timer is not None:
+            try:
+                self.app.cancel_timer(self.timer)
+            except Exception:
+                pass
+            self.timer = None
+
+    def nudge(self, kwargs=None):
+        self.timer = None
+        if self.found:
+            return
+
+        if not self.hints:
+            self.app.log(f"No VRM ID found on {self.topic} yet, still waiting", level="WARNING")
+            return
+
+        for vrm_id in self.hints:
+            self.app.log(f"No VRM ID found yet, sending keepalive to {vrm_id}")
+            self.mqtt_mgr.publish(f"{self.prefix}/R/{vrm_id}/keepalive", "")
+
+    def handle(self, topic, message, userdata):
+        levels = topic.split("/")
+        if len(levels) <= self.level:
+            return
+
+        vrm_id = levels[self.level]
+        if vrm_id in self.found:
+            return
+
+        serial = message.value
+        if serial and serial != vrm_id:
+            self.lazy_log.warning("Serial %s doesn't match portal ID %s", serial, vrm_id)
+
+        self.found.add(vrm_id)
+        self.cancel()
+        self.app.log(f"Found VRM ID {vrm_id}")
+
+        try:
+            self.on_found(vrm_id)
+        except Exception as e:
+            self.app.log(f"Error adding VRM ID {vrm_id}: {e}")
+            self.app.log(traceback.format_exc())